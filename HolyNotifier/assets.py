@@ -0,0 +1,80 @@
+import gzip
+import hashlib
+import mimetypes
+from pathlib import Path
+
+from fastapi import Request, Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Сжимать совсем маленькие файлы нет смысла
+MIN_COMPRESS_SIZE = 256
+
+
+class Asset:
+    # Файл целиком в памяти вместе с заранее сжатыми вариантами.
+    # У каждого варианта свой сильный ETag, повторный запрос получает 304.
+    def __init__(self, path: Path, cache_control: str) -> None:
+        body = path.read_bytes()
+        content_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+        if content_type.startswith("text/") or content_type.endswith("javascript"):
+            content_type += "; charset=utf-8"
+        self.content_type = content_type
+        self.cache_control = cache_control
+        tag = hashlib.sha256(body).hexdigest()[:16]
+        self.variants = {"identity": (body, f'"{tag}"')}
+        if len(body) >= MIN_COMPRESS_SIZE:
+            if brotli is not None:
+                self.variants["br"] = (brotli.compress(body), f'"{tag}-br"')
+            self.variants["gzip"] = (gzip.compress(body, 9, mtime=0), f'"{tag}-gz"')
+
+    def choose(self, accept_encoding: str) -> str:
+        # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Accept-Encoding
+        accepted = set()
+        for part in accept_encoding.lower().split(","):
+            name, _, params = part.partition(";")
+            params = params.replace(" ", "")
+            try:
+                quality = float(params[2:]) if params.startswith("q=") else 1
+            except ValueError:
+                quality = 0
+            if quality > 0:
+                accepted.add(name.strip())
+        for encoding in ("br", "gzip"):
+            if encoding in self.variants and (encoding in accepted or "*" in accepted):
+                return encoding
+        return "identity"
+
+    def respond(self, request: Request) -> Response:
+        encoding = self.choose(request.headers.get("Accept-Encoding", ""))
+        body, etag = self.variants[encoding]
+        headers = {
+            "ETag": etag,
+            "Cache-Control": self.cache_control,
+            "Vary": "Accept-Encoding",
+        }
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        if_none_match = request.headers.get("If-None-Match", "")
+        if etag in (tag.strip() for tag in if_none_match.split(",")) or (
+            if_none_match.strip() == "*"
+        ):
+            return Response(status_code=304, headers=headers)
+        return Response(body, media_type=self.content_type, headers=headers)
+
+
+class Assets:
+    # index.html и всё из static загружаются один раз при запуске
+    def __init__(self, index: str, static: str) -> None:
+        self.index = Asset(Path(index), "no-cache")
+        self.static = {
+            path.relative_to(static).as_posix(): Asset(path, "public, max-age=3600")
+            for path in Path(static).rglob("*")
+            if path.is_file()
+        }
+
+    def get(self, path: str) -> Asset:
+        return self.static.get(path)
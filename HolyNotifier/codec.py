@@ -0,0 +1,83 @@
+import json
+from os import getenv
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson.JSONDecodeError наследуется от json.JSONDecodeError
+DecodeError = json.JSONDecodeError
+
+
+def stdlib_loads(data):
+    return json.loads(data)
+
+
+def stdlib_dumps(obj, sort_keys: bool = False) -> bytes:
+    # Без пробелов и \u-экранирования, чтобы вывод совпадал с orjson
+    return json.dumps(
+        obj, separators=(",", ":"), ensure_ascii=False, sort_keys=sort_keys
+    ).encode()
+
+
+def orjson_dumps(obj, sort_keys: bool = False) -> bytes:
+    return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+
+
+# Json_Codec=json принудительно включает стандартную библиотеку
+if orjson is not None and getenv("Json_Codec", "orjson") == "orjson":
+    loads = orjson.loads
+    dumps = orjson_dumps
+else:
+    loads = stdlib_loads
+    dumps = stdlib_dumps
+
+
+def dumps_text(obj, sort_keys: bool = False) -> str:
+    return dumps(obj, sort_keys).decode()
+
+
+async def read_json(response):
+    # Разбор прямо из байтов ответа aiohttp, без промежуточной строки
+    return loads(await response.read())
+
+
+if __name__ == "__main__":
+    from timeit import timeit
+
+    event = {
+        "subscription": {
+            "id": "f1c2a387-161a-49f9-a165-0f21d7a4e1c4",
+            "type": "channel.update",
+            "version": "2",
+            "status": "enabled",
+            "cost": 0,
+            "condition": {"broadcaster_user_id": "1337"},
+            "transport": {"method": "webhook", "callback": "https://example.com"},
+            "created_at": "2023-06-29T17:20:33.860897266Z",
+        },
+        "event": {
+            "broadcaster_user_id": "1337",
+            "broadcaster_user_login": "cool_user",
+            "broadcaster_user_name": "Cool_User",
+            "title": "Лучший стрим на свете 🎉",
+            "language": "ru",
+            "category_id": "21779",
+            "category_name": "Fortnite",
+            "content_classification_labels": ["MatureGame"],
+        },
+    }
+    page = {"data": [event["subscription"]] * 100, "total": 100, "total_cost": 0}
+    codecs = {"json": (stdlib_loads, stdlib_dumps)}
+    if orjson is not None:
+        codecs["orjson"] = (orjson.loads, orjson_dumps)
+    for name, payload in (("event", event), ("page", page)):
+        raw = stdlib_dumps(payload)
+        for codec, (decode, encode) in codecs.items():
+            decode_time = timeit(lambda: decode(raw), number=10000)
+            encode_time = timeit(lambda: encode(payload), number=10000)
+            print(
+                f"{name:6} {codec:7} loads {decode_time * 100:.2f} мкс"
+                f"  dumps {encode_time * 100:.2f} мкс"
+            )
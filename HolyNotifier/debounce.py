@@ -0,0 +1,92 @@
+import asyncio
+from time import monotonic, time
+
+from resilience import clear_deadline
+from shared import get_shared_state, is_shared
+
+
+class Debouncer:
+    # Собирает события одного канала, пока они приходят чаще, чем раз в window секунд,
+    # и передаёт их в callback одной пачкой. Дольше max_wait * window пачка не копится.
+    # При нескольких воркерах пачка копится в общем состоянии, а таймер держит тот
+    # воркер, который первым получил событие.
+    def __init__(self, callback, max_wait: int = 4) -> None:
+        self.callback = callback
+        self.max_wait = max_wait
+        self.pending: dict[str, dict] = {}
+        self.tasks: dict[str, asyncio.Task] = {}
+
+    async def add(self, key: str, window: float, channel: dict, update) -> None:
+        if is_shared():
+            return await self.add_shared(key, window, channel, update)
+        pending = self.pending.get(key)
+        if pending is None:
+            pending = self.pending[key] = {
+                "channel": channel,
+                "updates": [],
+                "started": monotonic(),
+                "task": None,
+            }
+        pending["updates"].append(update)
+        if pending["task"]:
+            pending["task"].cancel()
+        delay = min(window, pending["started"] + window * self.max_wait - monotonic())
+        pending["task"] = asyncio.create_task(self.flush_later(key, max(delay, 0)))
+
+    async def add_shared(self, key: str, window: float, channel: dict, update) -> None:
+        now = time()
+
+        def change(pending: dict) -> dict:
+            if pending is None:
+                pending = {"channel": channel, "updates": [], "started": now}
+            pending["updates"].append(update)
+            pending["due"] = min(
+                now + window, pending["started"] + window * self.max_wait
+            )
+            return pending
+
+        ttl = window * self.max_wait + 60
+        await get_shared_state().modify("debounce_" + key, change, ttl)
+        # Сначала пачка, потом таймер: flush снимает таймер до того, как забрать пачку,
+        # поэтому событие не останется без таймера
+        if await get_shared_state().add_once("debounce_timer_" + key, ttl):
+            self.tasks[key] = asyncio.create_task(self.wait_shared(key))
+
+    async def flush_later(self, key: str, delay: float) -> None:
+        clear_deadline()
+        await asyncio.sleep(delay)
+        try:
+            await self.flush(key, cancel=False)
+        except Exception as e:
+            print("Debounced flush failed:", e)
+
+    async def wait_shared(self, key: str) -> None:
+        clear_deadline()
+        try:
+            while True:
+                pending = await get_shared_state().get("debounce_" + key)
+                if pending is None or pending["due"] <= time():
+                    break
+                await asyncio.sleep(pending["due"] - time())
+            await self.flush(key, cancel=False)
+        except Exception as e:
+            print("Debounced flush failed:", e)
+
+    async def flush(self, key: str, cancel: bool = True) -> None:
+        if is_shared():
+            task = self.tasks.pop(key, None)
+            if cancel and task:
+                task.cancel()
+            await get_shared_state().delete("debounce_timer_" + key)
+            pending = await get_shared_state().pop("debounce_" + key)
+        else:
+            pending = self.pending.pop(key, None)
+            if pending and cancel and pending["task"]:
+                pending["task"].cancel()
+        if pending is None:
+            return
+        await self.callback(key, pending["channel"], pending["updates"])
+
+    async def flush_all(self) -> None:
+        for key in list(self.pending) + list(self.tasks):
+            await self.flush(key)
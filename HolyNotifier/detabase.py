@@ -2,8 +2,12 @@ import asyncio
 from os import getenv
 from urllib.parse import quote
 
+from codec import dumps, read_json
+from resilience import breakers, hedge
 from utils import get_session
 
+TIMEOUT = 5
+
 
 class Base:
     def __init__(self, base_name: str) -> None:
@@ -11,6 +15,8 @@ class Base:
         self.project_key = getenv("DETA_PROJECT_KEY", "")
         self.project_id = self.project_key.split("_")[0]
         self.base_name = base_name
+        # Hedge_Delay - через сколько секунд повторить медленный GET (0 - не повторять)
+        self.hedge_delay = float(getenv("Hedge_Delay") or 0)
 
     async def put(self, items: list[dict]):
         # https://deta.space/docs/en/build/reference/http-api/base#put-items
@@ -18,9 +24,18 @@ class Base:
             items = [items]
         return await self.make_api_request("PUT", "items", json={"items": items})
 
+    async def insert(self, item: dict) -> dict:
+        # https://deta.space/docs/en/build/reference/http-api/base#insert-item
+        # Возвращает None, если элемент с таким ключом уже есть
+        response = await self.make_api_request("POST", "items", json={"item": item})
+        return response if "key" in response else None
+
     async def get(self, key: str, default = None) -> dict:
         # https://deta.space/docs/en/build/reference/http-api/base#get-item
-        response = await self.make_api_request("GET", f"items/{quote(key)}")
+        response = await hedge(
+            lambda: self.make_api_request("GET", f"items/{quote(key)}"),
+            self.hedge_delay,
+        )
         return response if len(response) > 1 else default
 
     async def get_many(self, keys: list[str]) -> list[dict]:
@@ -77,13 +92,15 @@ class Base:
     ) -> dict:
         if self.session is None:
             self.session = await get_session()
-        response = await self.session.request(
+        response = await breakers["deta"].request(
+            self.session,
             method,
             f"https://database.deta.sh/v1/{self.project_id}/{self.base_name}/{endpoint}",
+            TIMEOUT,
             headers={"X-API-Key": self.project_key, "Content-Type": "application/json"},
-            json=json,
+            data=dumps(json) if json is not None else None,
         )
-        return await response.json()
+        return await read_json(response)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,49 @@
+import asyncio
+from time import monotonic
+
+from resilience import clear_deadline
+
+
+class Digest:
+    # Когда много каналов начинают стрим одновременно, уведомления копятся
+    # window секунд и отправляются одним сообщением или альбомом.
+    # Первое уведомление после тишины отправляется сразу.
+    def __init__(self, deliver, deliver_many, window: float = 0) -> None:
+        self.deliver = deliver
+        self.deliver_many = deliver_many
+        self.window = window
+        self.buffers: dict[int, list[dict]] = {}
+        self.tasks: dict[int, asyncio.Task] = {}
+        self.last_seen: dict[int, float] = {}
+
+    async def add(self, chat_id: int, item: dict):
+        now = monotonic()
+        last = self.last_seen.get(chat_id, 0)
+        self.last_seen[chat_id] = now
+        if chat_id not in self.buffers and now - last >= self.window:
+            return await self.deliver(chat_id, item)
+        self.buffers.setdefault(chat_id, []).append(item)
+        if chat_id not in self.tasks:
+            self.tasks[chat_id] = asyncio.create_task(self.flush_later(chat_id))
+
+    async def flush_later(self, chat_id: int) -> None:
+        clear_deadline()
+        await asyncio.sleep(self.window)
+        try:
+            await self.flush(chat_id)
+        except Exception as e:
+            print("Digest flush failed:", e)
+
+    async def flush(self, chat_id: int) -> None:
+        task = self.tasks.pop(chat_id, None)
+        if task and task is not asyncio.current_task():
+            task.cancel()
+        items = self.buffers.pop(chat_id, [])
+        if len(items) == 1:
+            await self.deliver(chat_id, items[0])
+        elif items:
+            await self.deliver_many(chat_id, items)
+
+    async def flush_all(self) -> None:
+        for chat_id in list(self.buffers):
+            await self.flush(chat_id)
@@ -0,0 +1,202 @@
+import re
+from functools import lru_cache
+
+# https://core.telegram.org/bots/api#messageentity
+# Шаблон размечается как MarkdownV2, но разбирается один раз: получается список
+# кусков (текст или переменная) и сущности, привязанные к номерам кусков.
+# При подстановке остаётся только посчитать смещения в UTF-16, экранировать нечего.
+TOKEN = re.compile(
+    r"\\(.)"
+    r"|\$(?:(\$)|((?a:[_a-z][_a-z0-9]*))|\{((?a:[_a-z][_a-z0-9]*))\})"
+    r"|(\|\||__|[*_~`\[]|\]\()",
+    re.IGNORECASE,
+)
+ENTITY_TYPES = {
+    "*": "bold",
+    "_": "italic",
+    "__": "underline",
+    "~": "strikethrough",
+    "||": "spoiler",
+    "`": "code",
+    "[": "text_link",
+}
+MAX_CACHED = 256
+
+
+def utf16_len(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+class CompiledTemplate:
+    # lines - список строк, строка - список кусков:
+    # (None, текст, длина в UTF-16) или (имя переменной, исходный текст, None).
+    # entities - (тип, номер первого куска, номер куска после последнего, ссылка),
+    # номера сквозные по всем строкам.
+    def __init__(self, lines: list, entities: list) -> None:
+        self.lines = lines
+        self.entities = entities
+        self.identifiers = [
+            [piece[0] for piece in line if piece[0] is not None] for line in lines
+        ]
+        self.names = {name for names in self.identifiers for name in names}
+        # Переменные в адресах ссылок тоже нужно подставлять
+        for _, _, _, url in entities:
+            if url is not None:
+                self.names.update(name for name, _, _ in url if name is not None)
+
+    def render(self, values: dict, skip: set = frozenset()) -> tuple:
+        # values: имя переменной -> строка или None.
+        # Строка пропускается, если в ней одна переменная из skip и её нет.
+        parts = []
+        offsets = []
+        offset = 0
+        for line, identifiers in zip(self.lines, self.identifiers):
+            skip_line = (
+                len(set(identifiers)) == 1
+                and identifiers[0] in skip
+                and values.get(identifiers[0], "") is None
+            )
+            if not skip_line and parts:
+                parts.append("\n")
+                offset += 1
+            for name, text, length in line:
+                offsets.append(offset)
+                if skip_line:
+                    continue
+                if name is not None:
+                    text = substitute(name, text, values)
+                    length = utf16_len(text)
+                parts.append(text)
+                offset += length
+        offsets.append(offset)
+        entities = []
+        for type, start, end, url in self.entities:
+            length = offsets[end] - offsets[start]
+            if length <= 0:
+                continue
+            entity = {"type": type, "offset": offsets[start], "length": length}
+            if url is not None:
+                entity["url"] = "".join(
+                    substitute(name, text, values) if name else text
+                    for name, text, _ in url
+                )
+                # Кривая ссылка не должна ломать отправку всего сообщения
+                if not entity["url"].startswith(("https://", "http://")):
+                    continue
+            entities.append(entity)
+        entities.sort(key=lambda entity: (entity["offset"], -entity["length"]))
+        return "".join(parts), entities
+
+
+def substitute(name: str, text: str, values: dict) -> str:
+    # Неизвестные переменные остаются как есть, как в Template.safe_substitute
+    if name not in values:
+        return text
+    return values[name] or "-"
+
+
+def tokenize(text: str) -> list:
+    pieces = []
+    position = 0
+    while True:
+        match = TOKEN.search(text, position)
+        if match is None:
+            break
+        if match.start() > position:
+            pieces.append(("text", text[position : match.start()]))
+        position = match.end()
+        escaped, dollar, named, braced, mark = match.groups()
+        if escaped is not None:
+            pieces.append(("text", escaped))
+        elif dollar is not None:
+            pieces.append(("text", "$"))
+        elif named or braced:
+            pieces.append(("var", (named or braced).lower(), match.group()))
+        elif mark == "](":
+            end = text.find(")", position)
+            if end == -1:
+                pieces.append(("text", mark))
+            else:
+                url = text[position:end]
+                pieces.append(("link", tokenize(url), url))
+                position = end + 1
+        else:
+            pieces.append(("mark", mark))
+    if position < len(text):
+        pieces.append(("text", text[position:]))
+    return pieces
+
+
+def find(stack: list, mark: str) -> int:
+    for i in range(len(stack) - 1, -1, -1):
+        if stack[i][1] == mark:
+            return i
+    return None
+
+
+def literal(token: tuple) -> str:
+    if token[0] == "link":
+        return "](" + token[2] + ")"
+    return token[1]
+
+
+@lru_cache(maxsize=MAX_CACHED)
+def compile_template(template: str) -> CompiledTemplate:
+    lines = []
+    entities = []
+    index = 0
+    for source in template.split("\n"):
+        tokens = tokenize(source)
+        # Парные отметки внутри строки становятся сущностями, непарные - текстом
+        paired = {}
+        stack = []
+        for i, token in enumerate(tokens):
+            if token[0] == "mark" and token[1] != "[":
+                opener = find(stack, token[1])
+                if opener is None:
+                    stack.append((i, token[1]))
+                else:
+                    paired[stack[opener][0]] = i
+                    del stack[opener:]
+            elif token[0] == "mark":
+                stack.append((i, "["))
+            elif token[0] == "link":
+                opener = find(stack, "[")
+                if opener is not None:
+                    paired[stack[opener][0]] = i
+                    del stack[opener:]
+        closers = {end: start for start, end in paired.items()}
+        line = []
+        starts = {}
+        for i, token in enumerate(tokens):
+            kind = token[0]
+            if i in paired:
+                starts[i] = index + len(line)
+                continue
+            if i in closers:
+                url = None
+                if kind == "link":
+                    url = [
+                        (piece[1], piece[2], None)
+                        if piece[0] == "var"
+                        else (None, literal(piece), None)
+                        for piece in token[1]
+                    ]
+                type = ENTITY_TYPES[tokens[closers[i]][1]]
+                entities.append((type, starts[closers[i]], index + len(line), url))
+                continue
+            if kind == "var":
+                line.append((token[1], token[2], None))
+            else:
+                text = literal(token)
+                line.append((None, text, utf16_len(text)))
+        # Пустой кусок, чтобы у сущности в конце строки была граница внутри строки
+        line.append((None, "", 0))
+        index += len(line)
+        lines.append(line)
+    return CompiledTemplate(lines, entities)
+
+
+def shift(entities: list, offset: int) -> list:
+    # Смещение сущностей при склейке нескольких сообщений в одно
+    return [dict(entity, offset=entity["offset"] + offset) for entity in entities]
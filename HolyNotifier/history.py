@@ -0,0 +1,173 @@
+import asyncio
+from bisect import bisect_left
+from time import monotonic, time
+
+from shared import is_shared
+from timeline import Timeline
+
+RETENTION = 90 * 24 * 60 * 60
+COMPACT_EVERY = 50
+TTL = 60
+COLUMNS = (
+    "start",
+    "end",
+    "seg_session",
+    "seg_category",
+    "seg_start",
+    "title_session",
+    "title_time",
+    "title",
+)
+
+
+class History:
+    # Журнал стримов канала в документе history_<id>. Данные хранятся по столбцам:
+    # сессии (start, end), отрезки категорий (seg_*) и смены названия (title_*).
+    # Категории хранятся номерами в names. Новые строки только дописываются через append,
+    # старые сессии удаляются при сжатии раз в COMPACT_EVERY устаревших сессий.
+    def __init__(self, config) -> None:
+        self.config = config
+        self.cache: dict[str, dict] = {}
+        self.loaded: dict[str, float] = {}
+        self.missing: set[str] = set()
+
+    @staticmethod
+    def key(broadcaster_user_id: str) -> str:
+        return f"history_{broadcaster_user_id}"
+
+    async def load(self, broadcaster_user_id: str, fresh: bool = False) -> dict:
+        # При нескольких воркерах документ мог дописать другой воркер, поэтому
+        # копия в памяти живёт не дольше TTL секунд, а перед записью читается заново
+        cached = broadcaster_user_id in self.cache and not fresh
+        if cached and is_shared():
+            cached = monotonic() - self.loaded[broadcaster_user_id] < TTL
+        if not cached:
+            doc = await self.config.get(self.key(broadcaster_user_id))
+            if doc:
+                self.missing.discard(broadcaster_user_id)
+            else:
+                # Пустой журнал только в памяти, в базу он попадёт при первом append
+                doc = {"key": self.key(broadcaster_user_id)}
+                self.missing.add(broadcaster_user_id)
+            for column in ("names",) + COLUMNS:
+                doc.setdefault(column, [])
+            self.cache[broadcaster_user_id] = doc
+            self.loaded[broadcaster_user_id] = monotonic()
+        return self.cache[broadcaster_user_id]
+
+    async def load_many(self, ids: list) -> list[dict]:
+        return await asyncio.gather(*(self.load(id) for id in ids))
+
+    async def append(self, broadcaster_user_id: str, channel: dict, end: float) -> None:
+        timeline = Timeline.from_channel(channel)
+        if not timeline:
+            return
+        doc = await self.load(broadcaster_user_id, fresh=is_shared())
+        session = len(doc["start"])
+        row = {column: [] for column in COLUMNS}
+        row["start"].append(timeline.started_at)
+        row["end"].append(end)
+        names = []
+        for category, start in timeline.segments:
+            if category not in doc["names"]:
+                doc["names"].append(category)
+                names.append(category)
+            row["seg_session"].append(session)
+            row["seg_category"].append(doc["names"].index(category))
+            row["seg_start"].append(start)
+        for timestamp, title in channel.get("titles") or []:
+            row["title_session"].append(session)
+            row["title_time"].append(timestamp)
+            row["title"].append(title)
+        for column, values in row.items():
+            doc[column] += values
+        append = {column: values for column, values in row.items() if values}
+        if names:
+            append["names"] = names
+        if broadcaster_user_id in self.missing:
+            await self.config.put(doc)
+            self.missing.discard(broadcaster_user_id)
+        else:
+            await self.config.update(self.key(broadcaster_user_id), append=append)
+        if bisect_left(doc["start"], end - RETENTION) >= COMPACT_EVERY:
+            await self.compact(broadcaster_user_id, end)
+
+    async def compact(self, broadcaster_user_id: str, now: float = None) -> None:
+        # Документ перечитывается прямо перед перезаписью, чтобы не потерять сессии,
+        # дописанные другим воркером после загрузки в кэш
+        doc = await self.load(broadcaster_user_id, fresh=True)
+        first = bisect_left(doc["start"], (now or time()) - RETENTION)
+        new = {"key": doc["key"], "names": []}
+        new.update({column: [] for column in COLUMNS})
+        new["start"] = doc["start"][first:]
+        new["end"] = doc["end"][first:]
+        for i, session in enumerate(doc["seg_session"]):
+            if session < first:
+                continue
+            name = doc["names"][doc["seg_category"][i]]
+            if name not in new["names"]:
+                new["names"].append(name)
+            new["seg_session"].append(session - first)
+            new["seg_category"].append(new["names"].index(name))
+            new["seg_start"].append(doc["seg_start"][i])
+        for i, session in enumerate(doc["title_session"]):
+            if session < first:
+                continue
+            new["title_session"].append(session - first)
+            new["title_time"].append(doc["title_time"][i])
+            new["title"].append(doc["title"][i])
+        self.cache[broadcaster_user_id] = new
+        self.loaded[broadcaster_user_id] = monotonic()
+        await self.config.put(new)
+
+    async def stats(self, ids: list, days: int, now: float = None) -> dict:
+        # Количество стримов, суммарная и средняя длительность и время по категориям за days дней
+        now = now or time()
+        since = now - days * 24 * 60 * 60
+        sessions = 0
+        total = 0
+        length = 0
+        categories = {}
+        for doc in await self.load_many(ids):
+            first = bisect_left(doc["end"], since)
+            for session in range(first, len(doc["start"])):
+                sessions += 1
+                total += doc["end"][session] - max(doc["start"][session], since)
+                length += doc["end"][session] - doc["start"][session]
+            segments = doc["seg_session"]
+            for i in range(bisect_left(segments, first), len(segments)):
+                session = segments[i]
+                if i + 1 < len(segments) and segments[i + 1] == session:
+                    end = doc["seg_start"][i + 1]
+                else:
+                    end = doc["end"][session]
+                played = end - max(doc["seg_start"][i], since)
+                if played <= 0:
+                    continue
+                name = doc["names"][doc["seg_category"][i]]
+                categories[name] = categories.get(name, 0) + played
+        return {
+            "sessions": sessions,
+            "total": total,
+            "average": length / sessions if sessions else 0,
+            "categories": dict(
+                sorted(categories.items(), key=lambda item: item[1], reverse=True)
+            ),
+        }
+
+    async def live_hours(
+        self, broadcaster_user_id: str, days: int = 28, now: float = None
+    ) -> list:
+        # Доля дней за последние days дней, в которые канал был в эфире в каждый час (UTC)
+        now = now or time()
+        since = now - days * 24 * 60 * 60
+        doc = await self.load(broadcaster_user_id)
+        seen = set()
+        for session in range(bisect_left(doc["end"], since), len(doc["start"])):
+            first = int(max(doc["start"][session], since) // 3600)
+            last = int(doc["end"][session] // 3600)
+            seen.update(range(first, min(last, first + 48) + 1))
+        hours = [0] * 24
+        for hour in seen:
+            hours[hour % 24] += 1 / days
+        return hours
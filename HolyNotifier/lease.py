@@ -0,0 +1,95 @@
+import asyncio
+import os
+import socket
+from time import time
+from uuid import uuid4
+
+from resilience import clear_deadline
+
+TTL = 60
+CLAIM_TTL = 24 * 60 * 60
+
+
+class Lease:
+    # Аренда в Deta: проверку подписок выполняет только тот экземпляр, который её захватил.
+    # token - счётчик захватов (fencing token), перед записью владелец сверяет его
+    # с тем, что лежит в базе. Захватить аренду с номером token + 1 можно только
+    # через insert ключа lease_<name>_<номер>, который не перезаписывает существующий,
+    # поэтому из нескольких претендентов на одну и ту же истёкшую аренду побеждает один.
+    # Пока аренда удерживается, она продлевается каждые ttl / 3 секунд.
+    def __init__(self, config, name: str, ttl: int = TTL) -> None:
+        self.config = config
+        self.key = f"lease_{name}"
+        self.ttl = ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+        self.token: int = None
+        self.task: asyncio.Task = None
+
+    @property
+    def acquired(self) -> bool:
+        return self.token is not None
+
+    async def acquire(self) -> bool:
+        current = await self.config.get(self.key)
+        if current and current["expires"] >= time():
+            return False
+        # Без документа счётчик начинается с текущего времени, чтобы не наткнуться
+        # на ключи захватов, оставшиеся от удалённого документа
+        token = current["token"] + 1 if current else int(time())
+        # Ключи захватов хранятся дольше аренды, чтобы опоздавший претендент
+        # с устаревшим номером не смог захватить его повторно
+        claimed = await self.config.insert(
+            {
+                "key": f"{self.key}_{token}",
+                "owner": self.owner,
+                "__expires": int(time()) + CLAIM_TTL,
+            }
+        )
+        if not claimed:
+            return False
+        await self.config.put(
+            {
+                "key": self.key,
+                "owner": self.owner,
+                "token": token,
+                "expires": time() + self.ttl,
+            }
+        )
+        self.token = token
+        self.task = asyncio.create_task(self.renew())
+        return True
+
+    async def is_held(self) -> bool:
+        if self.token is None:
+            return False
+        current = await self.config.get(self.key)
+        return bool(current) and current["token"] == self.token
+
+    async def renew(self) -> None:
+        clear_deadline()
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                if not await self.is_held():
+                    print(f"Lease {self.key} lost by {self.owner}")
+                    self.token = None
+                    return
+                await self.config.update(self.key, set={"expires": time() + self.ttl})
+            except Exception as e:
+                print(f"Lease {self.key} renew failed:", e)
+
+    async def release(self) -> None:
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        if await self.is_held():
+            # Документ не удаляется, иначе счётчик захватов начнётся заново
+            await self.config.update(self.key, set={"expires": 0})
+        self.token = None
+
+    async def __aenter__(self) -> "Lease":
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.release()
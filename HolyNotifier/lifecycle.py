@@ -0,0 +1,53 @@
+import asyncio
+from time import monotonic
+
+SHUTDOWN_TIMEOUT = 20
+
+
+class Lifecycle:
+    # Учёт работы, которую нужно завершить перед остановкой процесса:
+    # обработчики вебхуков и фоновые задачи, запущенные через spawn.
+    # После начала остановки новые вебхуки не принимаются.
+    def __init__(self) -> None:
+        self.accepting = True
+        self.tasks: set[asyncio.Task] = set()
+
+    def track(self, task: asyncio.Task = None) -> None:
+        task = task or asyncio.current_task()
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self.track(task)
+        return task
+
+    async def wait_tasks(self) -> None:
+        current = asyncio.current_task()
+        tasks = [task for task in self.tasks if task is not current]
+        if tasks:
+            await asyncio.wait(tasks)
+
+    async def drain(self, steps: list, timeout: float = SHUTDOWN_TIMEOUT) -> list:
+        # steps - (название, функция без аргументов, возвращающая корутину).
+        # Шаги идут по порядку, пока не кончится общее время. Возвращает названия
+        # шагов, которые не успели или упали.
+        self.accepting = False
+        deadline = monotonic() + timeout
+        unfinished = []
+        for name, step in steps:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                unfinished.append(name)
+                continue
+            try:
+                await asyncio.wait_for(step(), remaining)
+            except asyncio.TimeoutError:
+                unfinished.append(name)
+            except Exception as e:
+                print(f"Shutdown step {name} failed:", e)
+                unfinished.append(name)
+        return unfinished
+
+
+lifecycle = Lifecycle()
@@ -0,0 +1,85 @@
+import asyncio
+from time import monotonic, time
+
+from resilience import clear_deadline
+from shared import get_shared_state, is_shared
+
+EDIT_INTERVAL = 30
+
+
+class LiveMessages:
+    # Одно сообщение на стрим: уведомление о начале стрима потом редактируется.
+    # Правки одного канала идут не чаще раза в interval секунд,
+    # а правки, пришедшие за это время, схлопываются в последнюю.
+    # При нескольких воркерах последняя правка, время прошлой правки и таймер
+    # хранятся в общем состоянии.
+    def __init__(self, edit, interval: float = EDIT_INTERVAL) -> None:
+        self.edit = edit
+        self.interval = interval
+        self.pending: dict[str, tuple] = {}
+        self.last_edit: dict[str, float] = {}
+        self.tasks: dict[str, asyncio.Task] = {}
+
+    async def update(self, key: str, *payload) -> None:
+        if is_shared():
+            return await self.update_shared(key, *payload)
+        self.pending[key] = payload
+        if key in self.tasks:
+            return
+        delay = self.last_edit.get(key, 0) + self.interval - monotonic()
+        if delay <= 0:
+            await self.flush(key)
+        else:
+            self.tasks[key] = asyncio.create_task(self.flush_later(key, delay))
+
+    async def update_shared(self, key: str, *payload) -> None:
+        state = get_shared_state()
+        await state.set("live_pending_" + key, list(payload), self.interval * 4)
+        delay = await state.get("live_edit_" + key, 0) + self.interval - time()
+        if delay <= 0:
+            await self.flush(key)
+        elif await state.add_once("live_timer_" + key, delay + self.interval):
+            self.tasks[key] = asyncio.create_task(self.flush_later(key, delay))
+
+    async def flush_later(self, key: str, delay: float) -> None:
+        clear_deadline()
+        await asyncio.sleep(delay)
+        try:
+            await self.flush(key, cancel=False)
+        except Exception as e:
+            print("Live message edit failed:", e)
+
+    async def flush(self, key: str, cancel: bool = True):
+        task = self.tasks.pop(key, None)
+        if cancel and task:
+            task.cancel()
+        if is_shared():
+            state = get_shared_state()
+            await state.delete("live_timer_" + key)
+            payload = await state.pop("live_pending_" + key)
+            if payload is None:
+                return None
+            await state.set("live_edit_" + key, time(), self.interval)
+        else:
+            payload = self.pending.pop(key, None)
+            if payload is None:
+                return None
+            self.last_edit[key] = monotonic()
+        return await self.edit(*payload)
+
+    async def finish(self, key: str, *payload):
+        # Последняя правка в конце стрима идёт сразу и заменяет отложенную
+        if is_shared():
+            await get_shared_state().set("live_pending_" + key, list(payload))
+        else:
+            self.pending[key] = payload
+        json = await self.flush(key)
+        if is_shared():
+            await get_shared_state().delete("live_edit_" + key)
+        else:
+            self.last_edit.pop(key, None)
+        return json
+
+    async def flush_all(self) -> None:
+        for key in list(self.pending) + list(self.tasks):
+            await self.flush(key)
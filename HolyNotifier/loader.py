@@ -0,0 +1,66 @@
+import asyncio
+
+from resilience import clear_deadline
+
+BATCH_SIZE = 100
+WINDOW = 0.005
+
+
+class Loader:
+    # Собирает запросы к Helix, сделанные почти одновременно (в пределах window секунд),
+    # и отправляет их одним запросом на каждые BATCH_SIZE id. Одинаковые id, в том числе
+    # уже отправленные и ещё не вернувшиеся, запрашиваются один раз.
+    # fetch(ids) возвращает список найденных объектов, key(объект) - его id.
+    def __init__(self, fetch, key, window: float = WINDOW) -> None:
+        self.fetch = fetch
+        self.key = key
+        self.window = window
+        self.queue: list = []
+        self.futures: dict[str, asyncio.Future] = {}
+        self.handle: asyncio.TimerHandle = None
+        # Цикл событий хранит на задачи только слабые ссылки
+        self.tasks: set[asyncio.Task] = set()
+
+    async def load_many(self, ids: list, return_exceptions: bool = False) -> list:
+        # Результат по порядку ids, None - если объект не найден.
+        # С return_exceptions на месте id из неудачной пачки будет исключение
+        loop = asyncio.get_running_loop()
+        futures = []
+        for id in ids:
+            future = self.futures.get(id)
+            if future is None:
+                future = self.futures[id] = loop.create_future()
+                self.queue.append(id)
+            futures.append(future)
+        if self.queue and self.handle is None:
+            self.handle = loop.call_later(self.window, self.dispatch)
+        # shield: отмена одного вызывающего не должна отменять результат для остальных
+        return await asyncio.gather(
+            *(asyncio.shield(future) for future in futures),
+            return_exceptions=return_exceptions,
+        )
+
+    def dispatch(self) -> None:
+        self.handle = None
+        queue, self.queue = self.queue, []
+        for i in range(0, len(queue), BATCH_SIZE):
+            task = asyncio.create_task(self.run(queue[i : i + BATCH_SIZE]))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def run(self, ids: list) -> None:
+        # Пачка общая для нескольких запросов, поэтому живёт по своим таймаутам
+        clear_deadline()
+        try:
+            items = await self.fetch(ids)
+        except Exception as e:
+            for id in ids:
+                future = self.futures.pop(id)
+                if not future.done():
+                    future.set_exception(e)
+            return
+        found = {self.key(item): item for item in items}
+        for id in ids:
+            future = self.futures.pop(id)
+            if not future.done():
+                future.set_result(found.get(id))
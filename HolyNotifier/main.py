@@ -2,17 +2,19 @@ import asyncio
 import secrets
 import string
 import traceback
+from contextlib import asynccontextmanager
 from os import getenv, environ
 
-import aiofiles
 from deta import Base
 from fastapi import FastAPI, Request, Response
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
 
-from utils import get, escape_symbols
+from assets import Assets
+from codec import loads
+from lifecycle import lifecycle
+from resilience import start_deadline
+from utils import close_session, get, escape_symbols
 
-from twitch import Twitch
+from twitch import Twitch, debouncer, settings
 
 twitch = Twitch(get("Client_Id"), get("Client_Secret"))
 
@@ -21,8 +23,72 @@ from telegram import Telegram
 telegram = Telegram(get("Telegram_Token"))
 
 
-app = FastAPI()
-app.mount("/static", StaticFiles(directory="./static"), name="static")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Прогрев кэша не должен мешать запуску, если Deta недоступна
+    lifecycle.spawn(warm_users())
+    twitch.sharding.start()
+    twitch.poller.start()
+    twitch.scheduler.start()
+    # Неотправленные до перезапуска уведомления отправляются заново
+    telegram.outbox.start()
+    # После обновления вебхук Telegram нужно переустановить с secret_token
+    lifecycle.spawn(telegram.subscribe())
+    # Документы каналов из старых версий хранили полную копию "global"
+    lifecycle.spawn(migrate_settings())
+    yield
+    await shutdown()
+
+
+async def warm_users():
+    try:
+        await twitch.warm_users()
+    except Exception as e:
+        print("Users cache warm-up failed:", e)
+
+
+async def migrate_settings():
+    try:
+        shrunk = await settings.migrate()
+        if shrunk:
+            print("Settings migrated for channels:", shrunk)
+    except Exception as e:
+        print("Settings migration failed:", e)
+
+
+async def shutdown():
+    # Новые вебхуки получают 503 и будут повторены Twitch и Telegram,
+    # а то, что уже принято, дописывается и отправляется, пока есть время
+    twitch.poller.stop()
+    twitch.scheduler.stop()
+    twitch.sharding.stop()
+    telegram.outbox.stop()
+    unfinished = await lifecycle.drain(
+        [
+            ("webhooks", lifecycle.wait_tasks),
+            ("debounced channel updates", debouncer.flush_all),
+            ("digest", telegram.digest.flush_all),
+            ("live message edits", telegram.live.flush_all),
+            ("outbox", telegram.outbox.drain),
+            ("chat states", telegram.states.flush),
+            ("bulk subscriptions", telegram.pending.flush),
+            ("shard membership", twitch.sharding.leave),
+        ]
+    )
+    left = telegram.outbox.pending()
+    telegram.outbox.close()
+    await close_session()
+    if unfinished or left:
+        print(
+            "Shutdown unfinished:",
+            ", ".join(unfinished) or "-",
+            f"| notifications left in outbox: {left}",
+        )
+
+
+app = FastAPI(lifespan=lifespan)
+assets = Assets("index.html", "static")
+checking: asyncio.Task = None
 
 config = Base(
     "dev_config" if "ngrok" in getenv("DETA_SPACE_APP_HOSTNAME") else "config"
@@ -61,62 +127,96 @@ if not getenv("secret", None):
                     "stream.offline": False,
                     "channel.update": False,
                 },
+                "debounce": {
+                    "channel.update": 0,
+                },
+                "live_message": False,
             },
             "global",
         )
 
 
 @app.get("/")
-async def index():
-    # Переписать?
-    if not telegram.token and telegram.get_telegram_token():
-        await telegram.subscribe()
-    if (
-        not twitch.client_id
-        or not twitch.client_secret
-        and twitch.get_client_id_and_client_secret()
-    ):
-        await twitch.subscribe()
-    async with aiofiles.open("index.html", "r") as f:
-        return HTMLResponse(await f.read())
+async def index(request: Request):
+    # Проверка ключей и подписок идёт в фоне, страница отдаётся сразу
+    global checking
+    if lifecycle.accepting and (checking is None or checking.done()):
+        checking = lifecycle.spawn(check_credentials())
+    return assets.index.respond(request)
+
+
+@app.get("/static/{path:path}")
+async def static(request: Request, path: str):
+    asset = assets.get(path)
+    if asset is None:
+        return Response(status_code=404)
+    return asset.respond(request)
+
+
+async def check_credentials():
+    # Ключи могли появиться в переменных окружения уже после запуска
+    try:
+        if not telegram.token and telegram.get_telegram_token():
+            await telegram.subscribe()
+        if (
+            not twitch.client_id
+            or not twitch.client_secret
+            and twitch.get_client_id_and_client_secret()
+        ):
+            await twitch.subscribe()
+    except Exception as e:
+        print("Credentials check failed:", e)
+
+
+async def report_exception(e: Exception):
+    name = str(e)
+    text = "".join(traceback.format_tb(e.__traceback__))
+    print(name, "\n", text)
+    chat_id = get("Telegram_Id")
+    if not chat_id:
+        return
+    # Срок запроса мог уже истечь, у отчёта свой срок
+    start_deadline()
+    try:
+        await telegram.send_message(
+            chat_id,
+            f"Exception occurred: {escape_symbols(name)}\\.\n```{escape_symbols(text)}```",
+            parse_mode="MarkdownV2",
+        )
+    except Exception as report_error:
+        print("Exception report failed:", report_error)
 
 
 @app.post("/twitchwebhook")
 async def twitchwebhook(request: Request, response: Response):
+    if not lifecycle.accepting:
+        return Response(status_code=503)
+    lifecycle.track()
+    # Все запросы к Deta, Helix и Telegram из обработчика укладываются в этот срок
+    start_deadline()
     try:
-        return await twitch.process_event(request, response)
+        await twitch.process_event(request, response)
     except Exception as e:
-        name = str(e)
-        text = "".join(traceback.format_tb(e.__traceback__))
-        print(name, "\n", text)
-        chat_id = get("Telegram_Id")
-        if chat_id:
-            await telegram.send_message(
-                chat_id,
-                f"Exception occurred: {escape_symbols(name)}\\.\n```{escape_symbols(text)}```",
-                parse_mode="MarkdownV2",
-            )
-    finally:
+        # Повтор того же события упал бы так же
         response.status_code = 200
-        response.init_headers()
-        return response
+        await report_exception(e)
+    # Статус из process_event сохраняется: например, 502, если владелец канала
+    # не принял пересланное событие, и Twitch повторит доставку
+    response.init_headers()
+    return response
 
 
 @app.post("/telegramwebhook")
 async def telegramwebhook(request: Request, response: Response):
+    if not lifecycle.accepting:
+        return Response(status_code=503)
+    lifecycle.track()
+    # Все запросы к Deta, Helix и Telegram из обработчика укладываются в этот срок
+    start_deadline()
     try:
         await telegram.process_event(request)
     except Exception as e:
-        name = str(e)
-        text = "".join(traceback.format_tb(e.__traceback__))
-        print(name, "\n", text)
-        chat_id = get("Telegram_Id")
-        if chat_id:
-            await telegram.send_message(
-                chat_id,
-                f"Exception occurred: {escape_symbols(name)}\\.\n```{escape_symbols(text)}```",
-                parse_mode="MarkdownV2",
-            )
+        await report_exception(e)
     finally:
         response.status_code = 200
         response.init_headers()
@@ -124,7 +224,8 @@ async def telegramwebhook(request: Request, response: Response):
 
 @app.post("/__space/v0/actions")
 async def space_actions(request: Request):
-    data = await request.json()
+    lifecycle.track()
+    data = loads(await request.body())
     if data["event"]["id"] == "check":
         await twitch.subscribe()
         await telegram.subscribe()
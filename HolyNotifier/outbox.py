@@ -0,0 +1,147 @@
+import asyncio
+import sqlite3
+from time import time
+
+from codec import dumps_text, loads
+from scheduler import jitter
+
+BATCH = 50
+CLAIM = 120
+POLL = 5
+BASE_DELAY = 5
+MAX_DELAY = 60 * 60
+MAX_ATTEMPTS = 8
+RETRY_CODES = (429, 500, 502, 503, 504)
+
+
+class Outbox:
+    # Журнал уведомлений в SQLite: уведомление записывается до ответа Twitch,
+    # а отправляет его фоновый воркер. Запись удаляется только после ответа Telegram,
+    # при ошибке повторяется с экспоненциальной задержкой, после MAX_ATTEMPTS попыток
+    # или при ошибке, которую повтор не исправит, переносится в таблицу dead.
+    # Воркер захватывает запись на claim секунд: если процесс упал, после перезапуска
+    # захват истечёт и запись отправится снова (доставка хотя бы один раз).
+    def __init__(self, dispatch, path: str, claim: float = CLAIM) -> None:
+        self.dispatch = dispatch
+        self.claim = claim
+        self.connection = sqlite3.connect(path, timeout=5, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " chat_id INTEGER, item TEXT, attempts INTEGER, next_at REAL,"
+            " claimed_until REAL, created REAL, error TEXT)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS dead (id INTEGER PRIMARY KEY, chat_id INTEGER,"
+            " item TEXT, attempts INTEGER, created REAL, failed REAL, error TEXT)"
+        )
+        self.wake: asyncio.Event = None
+        self.task: asyncio.Task = None
+
+    def add(self, chat_id: int, item: dict) -> int:
+        id = self.connection.execute(
+            "INSERT INTO outbox (chat_id, item, attempts, next_at, claimed_until,"
+            " created) VALUES (?, ?, 0, ?, 0, ?)",
+            (chat_id, dumps_text(item), time(), time()),
+        ).lastrowid
+        if self.wake:
+            self.wake.set()
+        return id
+
+    def start(self) -> None:
+        if self.task is None:
+            # Event создаётся уже в цикле событий uvicorn
+            self.wake = asyncio.Event()
+            self.task = asyncio.create_task(self.run())
+
+    def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.drain()
+            except Exception as e:
+                print("Outbox drain failed:", e)
+            try:
+                await asyncio.wait_for(self.wake.wait(), POLL)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+
+    def claim_due(self) -> list:
+        now = time()
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            rows = self.connection.execute(
+                "SELECT id, chat_id, item FROM outbox"
+                " WHERE next_at <= ? AND claimed_until <= ? ORDER BY id LIMIT ?",
+                (now, now, BATCH),
+            ).fetchall()
+            self.connection.executemany(
+                "UPDATE outbox SET claimed_until = ? WHERE id = ?",
+                [(now + self.claim, row[0]) for row in rows],
+            )
+        return rows
+
+    async def drain(self) -> None:
+        rows = self.claim_due()
+        while rows:
+            for id, chat_id, item in rows:
+                item = loads(item)
+                item["outbox_id"] = id
+                try:
+                    await self.dispatch(chat_id, item)
+                except Exception as e:
+                    print("Outbox dispatch failed:", e)
+                    await self.settle([item], None, str(e))
+            rows = self.claim_due()
+
+    async def settle(self, items: list, json: dict, error: str = None) -> None:
+        # Результат отправки: json - ответ Telegram или None, если запроса не было
+        ids = [item["outbox_id"] for item in items if "outbox_id" in item]
+        if not ids:
+            return
+        if json and json.get("ok"):
+            self.connection.executemany(
+                "DELETE FROM outbox WHERE id = ?", [(id,) for id in ids]
+            )
+            return
+        if json:
+            error = f"{json.get('error_code')}: {json.get('description')}"
+        permanent = bool(json) and json.get("error_code") not in RETRY_CODES
+        now = time()
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            for id in ids:
+                row = self.connection.execute(
+                    "SELECT chat_id, item, attempts, created FROM outbox WHERE id = ?",
+                    (id,),
+                ).fetchone()
+                if row is None:
+                    continue
+                attempts = row[2] + 1
+                if permanent or attempts >= MAX_ATTEMPTS:
+                    self.connection.execute(
+                        "INSERT OR REPLACE INTO dead VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (id, row[0], row[1], attempts, row[3], now, error),
+                    )
+                    self.connection.execute("DELETE FROM outbox WHERE id = ?", (id,))
+                    print(f"Notification {id} moved to dead letters:", error)
+                    continue
+                delay = jitter(min(BASE_DELAY * 2**attempts, MAX_DELAY))
+                self.connection.execute(
+                    "UPDATE outbox SET attempts = ?, next_at = ?, claimed_until = 0,"
+                    " error = ? WHERE id = ?",
+                    (attempts, now + delay, error, id),
+                )
+
+    def pending(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def close(self) -> None:
+        self.stop()
+        self.connection.close()
@@ -0,0 +1,103 @@
+import asyncio
+from time import time
+
+HOT_DIVIDER = 4
+TICK = 15
+
+
+class Poller:
+    # Запасной способ узнать о начале и конце стрима, если вебхук потерялся.
+    # Каналы опрашиваются через get_streams пачками по 100 id раз в interval секунд,
+    # а каналы, которые сейчас в эфире или обычно стримят в этот час, - в HOT_DIVIDER раз чаще.
+    # Найденные изменения отправляются в те же обработчики, что и события Twitch.
+    def __init__(self, twitch, config, history, handlers: dict, interval: float = 0):
+        self.twitch = twitch
+        self.config = config
+        self.history = history
+        self.handlers = handlers
+        self.interval = interval
+        self.live: dict[str, object] = {}
+        self.next_poll: dict[str, float] = {}
+        self.hours: dict[str, tuple] = {}
+        self.task: asyncio.Task = None
+
+    def start(self) -> None:
+        if self.interval and self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self) -> None:
+        channels = await self.config.query([{"is_live": True}])
+        for channel in channels["items"]:
+            # Id стрима может быть неизвестен, главное не прислать уведомление повторно
+            self.live[channel["key"]] = channel.get("stream_id") or True
+        while True:
+            try:
+                await self.tick()
+            except Exception as e:
+                print("Poll failed:", e)
+            await asyncio.sleep(min(TICK, self.interval / HOT_DIVIDER))
+
+    async def tick(self) -> None:
+        subscriptions = await self.config.get("subscriptions", {"value": []})
+        now = time()
+        due = [
+            sub["id"]
+            for sub in subscriptions["value"]
+            if self.twitch.sharding.owns(sub["id"])
+            and self.next_poll.get(sub["id"], 0) <= now
+        ]
+        if not due:
+            return
+        streams = await self.twitch.get_streams(due, partial=True)
+        live = {stream["user_id"]: stream for stream in streams["data"]}
+        # Каналы из неудачных пачек проверяются на следующем тике, без изменений
+        failed = set(streams["failed"])
+        if failed:
+            print(f"Poll failed for {len(failed)} channels")
+        for id in due:
+            if id in failed:
+                continue
+            stream = live.get(id)
+            previous = self.live.get(id)
+            if stream and previous is True:
+                pass
+            elif stream and previous != stream["id"]:
+                await self.fire("stream.online", id, stream)
+            elif not stream and previous:
+                await self.fire("stream.offline", id, None)
+            self.live[id] = stream["id"] if stream else None
+            self.next_poll[id] = now + await self.get_interval(id, now)
+
+    async def fire(self, type: str, id: str, stream: dict) -> None:
+        event = {"broadcaster_user_id": id}
+        if stream:
+            event.update(
+                {
+                    "id": stream["id"],
+                    "broadcaster_user_login": stream["user_login"],
+                    "broadcaster_user_name": stream["user_name"],
+                    "type": "live",
+                    "started_at": stream["started_at"],
+                }
+            )
+        await self.handlers[type](
+            {"subscription": {"type": type}, "event": event, "synthetic": True}
+        )
+
+    async def get_interval(self, id: str, now: float) -> float:
+        if self.live.get(id) or await self.usually_live(id, now):
+            return self.interval / HOT_DIVIDER
+        return self.interval
+
+    async def usually_live(self, id: str, now: float) -> bool:
+        # Гистограмма по часам пересчитывается не чаще раза в час
+        computed, hours = self.hours.get(id, (0, None))
+        if now - computed > 60 * 60:
+            hours = await self.history.live_hours(id, now=now)
+            self.hours[id] = (now, hours)
+        return hours[int(now // 3600) % 24] >= 0.25
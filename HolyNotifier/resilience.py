@@ -0,0 +1,151 @@
+import asyncio
+from contextvars import ContextVar
+from time import monotonic
+
+from aiohttp import ClientError, ClientTimeout
+
+WEBHOOK_DEADLINE = 10
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT = 30
+
+# Абсолютный срок (monotonic), до которого должна закончиться обработка запроса.
+# Задачи, созданные внутри обработчика, наследуют его вместе с контекстом.
+deadline: ContextVar[float] = ContextVar("deadline", default=None)
+
+
+class UpstreamError(Exception):
+    pass
+
+
+class CircuitOpen(UpstreamError):
+    pass
+
+
+class DeadlineExceeded(UpstreamError):
+    pass
+
+
+def start_deadline(seconds: float = WEBHOOK_DEADLINE) -> None:
+    deadline.set(monotonic() + seconds)
+
+
+def clear_deadline() -> None:
+    # Для фоновой работы, которая переживает запрос, породивший её
+    deadline.set(None)
+
+
+def remaining(default: float) -> float:
+    # Сколько можно ждать вызова: не больше default и не дольше срока запроса
+    end = deadline.get()
+    if end is None:
+        return default
+    left = end - monotonic()
+    if left <= 0:
+        raise DeadlineExceeded("Deadline exceeded")
+    return min(default, left)
+
+
+class CircuitBreaker:
+    # После threshold ошибок подряд (таймауты, обрывы, ответы 5xx) запросы к сервису
+    # сразу завершаются ошибкой. Через reset_timeout секунд пропускается один пробный
+    # запрос: если он успешен, всё возвращается в норму.
+    def __init__(
+        self,
+        name: str,
+        threshold: int = FAILURE_THRESHOLD,
+        reset_timeout: float = RESET_TIMEOUT,
+    ) -> None:
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: float = None
+        self.probing = False
+
+    def check(self) -> None:
+        if self.opened_at is None:
+            return
+        if self.probing or monotonic() - self.opened_at < self.reset_timeout:
+            raise CircuitOpen(f"{self.name} is unavailable")
+        self.probing = True
+
+    def success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def failure(self) -> None:
+        self.failures += 1
+        self.probing = False
+        if self.failures >= self.threshold:
+            if self.opened_at is None:
+                print(f"Circuit {self.name} opened")
+            self.opened_at = monotonic()
+
+    async def request(self, session, method: str, url: str, timeout: float, **kwargs):
+        self.check()
+        try:
+            response = await session.request(
+                method, url, timeout=ClientTimeout(total=remaining(timeout)), **kwargs
+            )
+        except DeadlineExceeded:
+            self.probing = False
+            raise
+        except (asyncio.TimeoutError, ClientError) as e:
+            self.failure()
+            raise UpstreamError(f"{self.name}: {e!r}") from e
+        except BaseException:
+            self.probing = False
+            raise
+        if response.status >= 500:
+            self.failure()
+        else:
+            self.success()
+        return response
+
+
+breakers = {
+    "deta": CircuitBreaker("deta"),
+    "helix": CircuitBreaker("helix"),
+    "telegram": CircuitBreaker("telegram"),
+}
+
+
+async def hedge(call, delay: float):
+    # Если ответ не пришёл за delay секунд, тот же идемпотентный запрос отправляется
+    # ещё раз, побеждает первый успешный
+    if not delay:
+        return await call()
+    tasks = {asyncio.ensure_future(call())}
+    done, _ = await asyncio.wait(tasks, timeout=delay)
+    if not done:
+        tasks.add(asyncio.ensure_future(call()))
+    error = None
+    winner = None
+    try:
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    error = task.exception()
+                elif winner is None:
+                    winner = task
+                else:
+                    release(task)
+            if winner is not None:
+                return winner.result()
+        raise error
+    finally:
+        # Проигравший запрос мог успеть получить ответ до отмены
+        for task in tasks:
+            task.cancel()
+            task.add_done_callback(release)
+
+
+def release(task: asyncio.Task) -> None:
+    # Ответ проигравшего запроса возвращает соединение в пул
+    if task.cancelled() or task.exception() is not None:
+        return
+    result = task.result()
+    if hasattr(result, "release"):
+        result.release()
@@ -0,0 +1,56 @@
+from collections import namedtuple
+
+# needs - имена значений, которые передаются в обработчик по порядку
+# (chat_id, text, event, state). state чата загружается, только если он нужен.
+Route = namedtuple("Route", ("handler", "needs", "private"))
+
+
+class Trie:
+    # Префиксное дерево для callback_data, выбирается самый длинный совпавший префикс,
+    # поэтому "live" и "live_" не мешают друг другу.
+    def __init__(self) -> None:
+        self.root = {}
+
+    def insert(self, prefix: str, value) -> None:
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node[None] = value
+
+    def longest_prefix(self, text: str):
+        node = self.root
+        found = node.get(None)
+        for char in text:
+            node = node.get(char)
+            if node is None:
+                break
+            found = node.get(None, found)
+        return found
+
+
+class Router:
+    def __init__(self) -> None:
+        self.commands: dict[str, Route] = {}
+        self.states: dict[str, Route] = {}
+        self.callbacks = Trie()
+
+    def command(self, name: str, handler, *needs: str, private: bool = True) -> None:
+        self.commands[name] = Route(handler, needs, private)
+
+    def state(self, name: str, handler, *needs: str) -> None:
+        self.states[name] = Route(handler, needs, True)
+
+    def callback(self, prefix: str, handler, *needs: str) -> None:
+        self.callbacks.insert(prefix, Route(handler, needs, True))
+
+    def get_callback(self, data: str) -> Route:
+        return self.callbacks.longest_prefix(data)
+
+    @staticmethod
+    async def dispatch(route: Route, values: dict, load_state):
+        args = []
+        for name in route.needs:
+            if name not in values and name == "state":
+                values["state"] = await load_state(values["chat_id"])
+            args.append(values[name])
+        return await route.handler(*args)
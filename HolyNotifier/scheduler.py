@@ -0,0 +1,165 @@
+import asyncio
+import random
+from time import time
+
+from lease import Lease
+from resilience import UpstreamError
+from shared import get_shared_state
+
+TICK = 15 * 60
+SLICE = 25
+RECHECK = 4 * 60 * 60
+FAILED_RECHECK = 15 * 60
+JITTER = 0.2
+TYPES = ("stream.online", "stream.offline", "channel.update")
+
+
+def jitter(seconds: float) -> float:
+    return seconds * random.uniform(1 - JITTER, 1 + JITTER)
+
+
+class Scheduler:
+    # Вместо полной проверки раз в 4 часа каждый тик проверяет не больше SLICE каналов,
+    # у которых подошла очередь. Канал проверяется раз в RECHECK секунд, а после ошибки
+    # или отзыва подписки - раз в FAILED_RECHECK. К интервалам добавляется случайный разброс.
+    # Лишние подписки ищутся постранично, по одной странице за тик.
+    # Очередь хранится в документе schedule: {id: {"next": время, "failures": число}}.
+    def __init__(self, twitch, config) -> None:
+        self.twitch = twitch
+        self.config = config
+        self.task: asyncio.Task = None
+
+    def start(self) -> None:
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(jitter(TICK))
+            try:
+                await self.tick()
+            except Exception as e:
+                print("Scheduled check failed:", e)
+
+    async def get_schedule(self) -> dict:
+        schedule = await self.config.get("schedule")
+        if not schedule:
+            schedule = {"key": "schedule", "value": {}}
+            await self.config.put(schedule)
+        return schedule["value"]
+
+    async def mark_failed(self, broadcaster_user_id: str) -> None:
+        await self.get_schedule()
+        await self.config.update(
+            "schedule", set={f"value.{broadcaster_user_id}.next": 0}
+        )
+
+    async def tick(self) -> bool:
+        # Тик может прийти и от действия check, и из фонового цикла
+        if not await get_shared_state().add_once("scheduler_tick", TICK / 2):
+            return False
+        name = "twitch_check"
+        if self.twitch.sharding.enabled:
+            name += "_" + self.twitch.sharding.member_id
+        async with Lease(self.config, name) as lease:
+            if not lease.acquired:
+                return False
+            subscriptions, schedule = await asyncio.gather(
+                self.config.get("subscriptions", {"value": []}),
+                self.get_schedule(),
+            )
+            ids = [
+                sub["id"]
+                for sub in subscriptions["value"]
+                if self.twitch.sharding.owns(sub["id"])
+            ]
+            now = time()
+            due = sorted(
+                (id for id in ids if schedule.get(id, {}).get("next", 0) <= now),
+                key=lambda id: schedule.get(id, {}).get("next", 0),
+            )[:SLICE]
+            subscribed = False
+            if due:
+                subscribed = await self.check(due, schedule, lease)
+            # Отписанные каналы убираются из очереди
+            stale = [
+                f"value.{id}"
+                for id in schedule
+                if id not in ids and self.twitch.sharding.owns(id)
+            ]
+            if stale:
+                await self.config.update("schedule", delete=stale)
+            await self.sweep(set(ids))
+            return subscribed
+
+    async def check(self, due: list, schedule: dict, lease: Lease) -> bool:
+        results = await asyncio.gather(*(self.check_channel(id) for id in due))
+        if not await lease.is_held():
+            return False
+        await self.twitch.refresh_channels(due)
+        update = {}
+        for id, (ok, created) in zip(due, results):
+            failures = 0 if ok else schedule.get(id, {}).get("failures", 0) + 1
+            # После ошибки или пересоздания подписки канал проверяется ещё раз скоро
+            period = RECHECK if ok and not created else FAILED_RECHECK
+            update[f"value.{id}"] = {
+                "next": int(time() + jitter(period)),
+                "failures": failures,
+            }
+        await self.config.update("schedule", set=update)
+        return any(created for ok, created in results)
+
+    async def check_channel(self, broadcaster_user_id: str) -> tuple:
+        subs = {}
+        try:
+            async for sub in self.twitch.iter_eventsub_subscriptions(
+                user_id=broadcaster_user_id
+            ):
+                if sub["condition"].get("broadcaster_user_id") == broadcaster_user_id:
+                    subs[sub["type"].replace(".", "")] = sub["id"]
+        except UpstreamError as e:
+            # Без полного списка ничего не пересоздаём, канал проверится снова скоро
+            print(f"Check of {broadcaster_user_id} failed:", e)
+            return False, False
+        missing = [type for type in TYPES if type.replace(".", "") not in subs]
+        if subs:
+            await self.config.update(broadcaster_user_id, set=subs)
+        if not missing:
+            return True, False
+        await self.twitch.check_eventsub_cost(len(missing))
+        responses = await asyncio.gather(
+            *(
+                self.twitch.create_eventsub_subscription(type, broadcaster_user_id)
+                for type in missing
+            )
+        )
+        ok = all(
+            response is True or (response and response.status == 202)
+            for response in responses
+        )
+        return ok, True
+
+    async def sweep(self, subscribed_ids: set) -> None:
+        # Одна страница списка подписок за тик, курсор хранится между тиками
+        shared = get_shared_state()
+        params = {"status": "enabled"}
+        cursor = await shared.get("sweep_cursor")
+        if cursor:
+            params["after"] = cursor
+        try:
+            page = await self.twitch.get_eventsub_page(params)
+        except UpstreamError as e:
+            print("Sweep failed:", e)
+            return
+        await shared.set("sweep_cursor", page.get("pagination", {}).get("cursor"))
+        tasks = []
+        for sub in page["data"]:
+            user_id = sub["condition"].get("broadcaster_user_id")
+            if self.twitch.sharding.owns(user_id) and user_id not in subscribed_ids:
+                tasks.append(self.twitch.delete_eventsub_subscription(sub["id"]))
+        await asyncio.gather(*tasks)
@@ -0,0 +1,157 @@
+import asyncio
+from time import monotonic
+
+from codec import dumps
+
+KEYS = (
+    "message",
+    "screenshot",
+    "disable_preview",
+    "disable_notifications",
+    "debounce",
+    "live_message",
+)
+TTL = 60
+LAYOUT = 1
+
+
+def merge(defaults: dict, overrides: dict) -> dict:
+    # Вложенные словари сливаются по ключам, остальное заменяется целиком
+    merged = dict(defaults)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def diff(defaults: dict, values: dict) -> dict:
+    # Только то, что отличается от defaults
+    overrides = {}
+    for key, value in values.items():
+        default = defaults.get(key)
+        if isinstance(value, dict) and isinstance(default, dict):
+            value = diff(default, value)
+            if value:
+                overrides[key] = value
+        elif key not in defaults or value != default:
+            overrides[key] = value
+    return overrides
+
+
+class Settings:
+    # В документе канала хранятся только его отличия от "global",
+    # итоговые настройки - это "global" с наложенными поверх отличиями.
+    # "global" перечитывается раз в ttl секунд (его меняют прямо в Deta Base),
+    # результат слияния кешируется, пока не поменяется "global" или сам канал.
+    def __init__(self, config, ttl: float = TTL) -> None:
+        self.config = config
+        self.ttl = ttl
+        self.defaults: dict = None
+        self.version: bytes = None
+        self.loaded = 0
+        self.loading: asyncio.Task = None
+        self.merged: dict[str, tuple] = {}
+
+    async def get_defaults(self) -> dict:
+        if self.defaults is None or monotonic() - self.loaded > self.ttl:
+            # Одновременные события ждут одного и того же чтения
+            if self.loading is None:
+                self.loading = asyncio.ensure_future(self.load())
+            try:
+                await asyncio.shield(self.loading)
+            finally:
+                if self.loading is not None and self.loading.done():
+                    self.loading = None
+        return self.defaults
+
+    async def load(self) -> None:
+        doc = await self.config.get("global") or {}
+        defaults = {key: doc[key] for key in KEYS if key in doc}
+        version = dumps(defaults, True)
+        if version != self.version:
+            self.defaults = defaults
+            self.version = version
+            self.merged.clear()
+        self.loaded = monotonic()
+
+    def invalidate(self, key: str = None) -> None:
+        # Без key - после изменения "global", с key - после изменения канала
+        if key is None:
+            self.loaded = 0
+            self.merged.clear()
+        else:
+            self.merged.pop(key, None)
+
+    async def resolve(self, channel: dict) -> dict:
+        defaults = await self.get_defaults()
+        overrides = {key: channel[key] for key in KEYS if key in channel}
+        version = dumps(overrides, True)
+        cached = self.merged.get(channel["key"])
+        if cached and cached[0] == version:
+            return cached[1]
+        merged = merge(defaults, overrides)
+        self.merged[channel["key"]] = (version, merged)
+        return merged
+
+    async def effective(self, channel: dict) -> dict:
+        # Документ канала вместе с итоговыми настройками, в базу его обратно не пишем
+        if channel is None:
+            return None
+        return dict(channel, **await self.resolve(channel))
+
+    async def migrate(self) -> int:
+        # Убирает из документов каналов копии "global", оставшиеся от старых версий.
+        # Выполняется один раз, отметка хранится в документе settings_layout
+        layout = await self.config.get("settings_layout")
+        if layout and layout["value"] >= LAYOUT:
+            return 0
+        self.invalidate()
+        defaults = await self.get_defaults()
+        subscriptions = await self.config.get("subscriptions", {"value": []})
+        ids = [sub["id"] for sub in subscriptions["value"]]
+        shrunk = 0
+        for i in range(0, len(ids), 25):
+            channels = await self.config.get_many(ids[i : i + 25])
+            for channel in channels:
+                if channel and await self.shrink(defaults, channel):
+                    shrunk += 1
+        await self.config.put({"key": "settings_layout", "value": LAYOUT})
+        return shrunk
+
+    async def shrink(self, defaults: dict, channel: dict) -> bool:
+        set = {}
+        delete = []
+        for key in KEYS:
+            if key not in channel:
+                continue
+            value = diff(
+                {key: defaults[key]} if key in defaults else {}, {key: channel[key]}
+            )
+            if not value:
+                delete.append(key)
+            elif value[key] != channel[key]:
+                set[key] = value[key]
+        if not set and not delete:
+            return False
+        # https://deta.space/docs/en/build/reference/http-api/base#update-item
+        # Ключи вроде "stream.online" содержат точку, поэтому вложенные словари
+        # записываются целиком, а не по путям
+        await self.config.update(channel["key"], set=set or None, delete=delete or None)
+        self.invalidate(channel["key"])
+        return True
+
+
+if __name__ == "__main__":
+    from os import getenv
+
+    from detabase import Base
+
+    async def main():
+        hostname = getenv("DETA_SPACE_APP_HOSTNAME", "")
+        config = Base("dev_config" if "ngrok" in hostname else "config")
+        await config.put({"key": "settings_layout", "value": 0})
+        print("Shrunk channels:", await Settings(config).migrate())
+
+    asyncio.run(main())
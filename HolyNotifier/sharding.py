@@ -0,0 +1,216 @@
+import asyncio
+import hashlib
+from bisect import bisect
+from os import getenv
+from time import time
+
+from codec import read_json
+from lease import Lease
+from resilience import CircuitBreaker, UpstreamError
+from utils import get_session
+
+HEARTBEAT = 60
+FORWARD_TIMEOUT = 5
+FORWARDED_MARK = "Holy-Forwarded-By"
+REPLICAS = 64
+FORWARDED_HEADERS = (
+    "Twitch-Eventsub-Message-Id",
+    "Twitch-Eventsub-Message-Timestamp",
+    "Twitch-Eventsub-Message-Signature",
+    "Twitch-Eventsub-Message-Type",
+    "Twitch-Eventsub-Subscription-Type",
+    "Twitch-Eventsub-Subscription-Version",
+)
+
+
+def hash_key(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    # Консистентное хэширование: при добавлении или удалении экземпляра
+    # переезжает только часть каналов
+    def __init__(self, nodes: list, replicas: int = REPLICAS) -> None:
+        self.nodes = sorted(nodes)
+        points = sorted(
+            (hash_key(f"{node}#{i}"), node)
+            for node in self.nodes
+            for i in range(replicas)
+        )
+        self.hashes = [point[0] for point in points]
+        self.owners = [point[1] for point in points]
+
+    def owner(self, key: str) -> str:
+        if not self.owners:
+            return None
+        return self.owners[bisect(self.hashes, hash_key(key)) % len(self.owners)]
+
+
+class Sharding:
+    # Режим нескольких экземпляров бота через EventSub conduit.
+    # Включается переменной Shard_Url (публичный адрес этого экземпляра).
+    # Экземпляры отмечаются в документе shards, каждый из них - шард conduit,
+    # а каналы распределяются между экземплярами через HashRing.
+    # Twitch может прислать событие любому шарду, поэтому чужие события пересылаются владельцу.
+    def __init__(self, twitch, config, url: str = None) -> None:
+        self.twitch = twitch
+        self.config = config
+        self.url = (url or "").rstrip("/")
+        # Экземпляры, между которыми каналы делятся сейчас
+        self.ring = HashRing([self.url] if self.url else [])
+        # Список экземпляров, для которого шарды conduit уже настроены.
+        # Пустой при запуске, поэтому первый join всегда настраивает conduit
+        self.members: list = []
+        self.conduit_id: str = None
+        # В ключах Deta точка разделяет вложенные поля, поэтому адрес хэшируется
+        self.member_id = hashlib.md5(self.url.encode()).hexdigest()[:12]
+        self.task: asyncio.Task = None
+        # Отдельный предохранитель на каждый экземпляр: недоступный владелец
+        # не должен мешать пересылке остальным
+        self.breakers: dict[str, CircuitBreaker] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.url)
+
+    def owns(self, broadcaster_user_id: str, headers=None) -> bool:
+        if headers is not None and FORWARDED_MARK in headers:
+            return True
+        return not self.enabled or self.ring.owner(broadcaster_user_id) == self.url
+
+    def owner(self, broadcaster_user_id: str) -> str:
+        return self.ring.owner(broadcaster_user_id)
+
+    def start(self) -> None:
+        if self.enabled and self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.join()
+            except Exception as e:
+                print("Shard heartbeat failed:", e)
+            await asyncio.sleep(HEARTBEAT)
+
+    async def join(self) -> None:
+        shards = await self.config.get("shards")
+        if not shards:
+            shards = {"key": "shards", "value": {}}
+            await self.config.put(shards)
+        members = {
+            member["url"]
+            for member in shards["value"].values()
+            if member["seen"] > time() - HEARTBEAT * 3
+        }
+        members.add(self.url)
+        await self.config.update(
+            "shards",
+            set={f"value.{self.member_id}": {"url": self.url, "seen": int(time())}},
+        )
+        members = sorted(members)
+        if members != self.ring.nodes:
+            self.ring = HashRing(members)
+        # Пока шарды не настроены, попытка повторяется на каждом heartbeat
+        if members != self.members and await self.rebalance(members):
+            self.members = members
+
+    async def leave(self) -> None:
+        if self.enabled:
+            await self.config.update("shards", delete=[f"value.{self.member_id}"])
+
+    async def get_conduit_id(self, shard_count: int = 1) -> str:
+        # https://dev.twitch.tv/docs/api/reference/#get-conduits
+        if self.conduit_id:
+            return self.conduit_id
+        response = await self.twitch.make_api_request(
+            "GET", "https://api.twitch.tv/helix/eventsub/conduits"
+        )
+        if response and response.status == 200:
+            conduits = (await read_json(response))["data"]
+            if conduits:
+                self.conduit_id = conduits[0]["id"]
+                return self.conduit_id
+        # https://dev.twitch.tv/docs/api/reference/#create-conduits
+        response = await self.twitch.make_api_request(
+            "POST",
+            "https://api.twitch.tv/helix/eventsub/conduits",
+            json={"shard_count": shard_count},
+        )
+        if response and response.status == 200:
+            self.conduit_id = (await read_json(response))["data"][0]["id"]
+        return self.conduit_id
+
+    async def rebalance(self, members: list) -> bool:
+        # Шард i - i-й экземпляр в отсортированном списке.
+        # True, только если Twitch принял новые шарды
+        async with Lease(self.config, "conduit") as lease:
+            if not lease.acquired:
+                return False
+            conduit_id = await self.get_conduit_id(len(members))
+            if not conduit_id:
+                return False
+            # https://dev.twitch.tv/docs/api/reference/#update-conduits
+            response = await self.twitch.make_api_request(
+                "PATCH",
+                "https://api.twitch.tv/helix/eventsub/conduits",
+                json={"id": conduit_id, "shard_count": len(members)},
+            )
+            if not response or response.status != 200:
+                return False
+            # https://dev.twitch.tv/docs/api/reference/#update-conduit-shards
+            response = await self.twitch.make_api_request(
+                "PATCH",
+                "https://api.twitch.tv/helix/eventsub/conduits/shards",
+                json={
+                    "conduit_id": conduit_id,
+                    "shards": [
+                        {
+                            "id": str(i),
+                            "transport": {
+                                "method": "webhook",
+                                "callback": f"{url}/twitchwebhook",
+                                "secret": getenv("secret"),
+                            },
+                        }
+                        for i, url in enumerate(members)
+                    ],
+                },
+            )
+            if not response or response.status != 202:
+                return False
+            # Шарды с ошибками возвращаются в errors при статусе 202
+            return not (await read_json(response)).get("errors")
+
+    async def forward(self, broadcaster_user_id: str, headers, body: bytes) -> bool:
+        # Подпись не меняется, владелец проверит её сам.
+        # False, если владелец не принял событие: тогда Twitch должен прислать его снова
+        session = await get_session()
+        forwarded = {name: headers[name] for name in FORWARDED_HEADERS if name in headers}
+        forwarded["Content-Type"] = "application/json"
+        # Если у экземпляров разные списки участников, событие не должно ходить по кругу
+        forwarded[FORWARDED_MARK] = self.member_id
+        owner = self.owner(broadcaster_user_id)
+        breaker = self.breakers.setdefault(owner, CircuitBreaker("shard " + owner))
+        try:
+            response = await breaker.request(
+                session,
+                "POST",
+                f"{owner}/twitchwebhook",
+                FORWARD_TIMEOUT,
+                data=body,
+                headers=forwarded,
+            )
+        except UpstreamError as e:
+            print("Forward failed:", e)
+            return False
+        async with response:
+            if not 200 <= response.status < 300:
+                print(f"Forward to {owner} failed with status {response.status}")
+                return False
+        return True
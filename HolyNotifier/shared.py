@@ -0,0 +1,177 @@
+import asyncio
+import sqlite3
+import threading
+from os import getenv
+from time import time
+
+from codec import dumps_text, loads
+
+CLEANUP_EVERY = 1000
+
+
+class MemoryState:
+    # Состояние внутри одного процесса, используется, когда воркер один
+    def __init__(self) -> None:
+        self.data: dict[str, tuple] = {}
+
+    async def get(self, key: str, default=None):
+        value, expires = self.data.get(key, (default, None))
+        if expires is not None and expires < time():
+            del self.data[key]
+            return default
+        return value
+
+    async def set(self, key: str, value, ttl: float = None) -> None:
+        self.data[key] = (value, time() + ttl if ttl else None)
+
+    async def delete(self, key: str) -> None:
+        self.data.pop(key, None)
+
+    async def add_once(self, key: str, ttl: float = None) -> bool:
+        # True, если ключа ещё не было (или он истёк). Нужен для дедупликации событий
+        if await self.get(key) is not None:
+            return False
+        await self.set(key, True, ttl)
+        return True
+
+    async def modify(self, key: str, change, ttl: float = None):
+        # Атомарно заменяет значение на change(старое значение или None).
+        # Если change вернул None, ключ удаляется
+        value = change(await self.get(key))
+        if value is None:
+            await self.delete(key)
+        else:
+            await self.set(key, value, ttl)
+        return value
+
+    async def pop(self, key: str, default=None):
+        value = await self.get(key, default)
+        await self.delete(key)
+        return value
+
+
+class SQLiteState:
+    # Общее состояние для нескольких воркеров uvicorn через локальный файл SQLite в режиме WAL.
+    # Запрос может ждать чужую запись до timeout секунд, поэтому все запросы идут
+    # в отдельном потоке, а не в цикле событий
+    def __init__(self, path: str) -> None:
+        self.connection = sqlite3.connect(
+            path, timeout=5, isolation_level=None, check_same_thread=False
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT, expires REAL)"
+        )
+        self.lock = threading.Lock()
+        self.operations = 0
+
+    async def run(self, function, *args):
+        return await asyncio.to_thread(self.locked, function, *args)
+
+    def locked(self, function, *args):
+        with self.lock:
+            return function(*args)
+
+    async def get(self, key: str, default=None):
+        return await self.run(self.read, key, default)
+
+    async def set(self, key: str, value, ttl: float = None) -> None:
+        await self.run(self.write, key, value, ttl)
+
+    async def delete(self, key: str) -> None:
+        await self.run(self.remove, key)
+
+    async def add_once(self, key: str, ttl: float = None) -> bool:
+        return await self.run(self.insert_once, key, ttl)
+
+    async def modify(self, key: str, change, ttl: float = None):
+        return await self.run(self.replace, key, change, ttl)
+
+    async def pop(self, key: str, default=None):
+        return await self.run(self.take, key, default)
+
+    def read(self, key: str, default=None):
+        row = self.connection.execute(
+            "SELECT value, expires FROM kv WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or (row[1] is not None and row[1] < time()):
+            return default
+        return loads(row[0])
+
+    def write(self, key: str, value, ttl: float = None) -> None:
+        self.connection.execute(
+            "INSERT OR REPLACE INTO kv VALUES (?, ?, ?)",
+            (key, dumps_text(value), time() + ttl if ttl else None),
+        )
+        self.cleanup()
+
+    def remove(self, key: str) -> None:
+        self.connection.execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def insert_once(self, key: str, ttl: float = None) -> bool:
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.execute(
+                "DELETE FROM kv WHERE key = ? AND expires < ?", (key, time())
+            )
+            added = self.connection.execute(
+                "INSERT OR IGNORE INTO kv VALUES (?, 'true', ?)",
+                (key, time() + ttl if ttl else None),
+            ).rowcount
+        self.cleanup()
+        return added == 1
+
+    def replace(self, key: str, change, ttl: float = None):
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            value = change(self.read(key))
+            if value is None:
+                self.remove(key)
+            else:
+                self.write(key, value, ttl)
+        return value
+
+    def take(self, key: str, default=None):
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            value = self.read(key, default)
+            self.remove(key)
+        return value
+
+    def cleanup(self) -> None:
+        self.operations += 1
+        if self.operations % CLEANUP_EVERY == 0:
+            self.connection.execute("DELETE FROM kv WHERE expires < ?", (time(),))
+
+
+shared = None
+
+
+def is_shared() -> bool:
+    # Несколько воркеров: кэши в памяти процесса могут устареть
+    return isinstance(get_shared_state(), SQLiteState)
+
+
+def get_shared_state():
+    # Shared_State - путь к файлу SQLite, общему для всех воркеров.
+    # Если не указан, состояние хранится в памяти процесса.
+    global shared
+    if shared is None:
+        path = getenv("Shared_State")
+        shared = SQLiteState(path) if path else MemoryState()
+    return shared
+
+
+async def get_timestamp(config, key: str, default: int) -> int:
+    # Время последней проверки: сначала из общего состояния, потом из Deta
+    value = await get_shared_state().get(key)
+    if value is None:
+        value = (await config.get(key, {"value": default}))["value"]
+        await get_shared_state().set(key, value)
+    return int(value)
+
+
+async def set_timestamp(config, key: str, value: int) -> None:
+    await get_shared_state().set(key, value)
+    await config.put({"key": key, "value": value})
@@ -0,0 +1,118 @@
+import asyncio
+from collections import OrderedDict
+from time import time
+
+from resilience import clear_deadline
+from shared import get_shared_state, is_shared
+
+TTL = 15 * 60
+FLUSH_DELAY = 1
+MAX_CACHED = 1000
+
+
+class StateStore:
+    # Состояние диалога отдельно для каждого чата (документ <prefix>_<chat_id>).
+    # Чтение идёт из памяти, из базы состояние чата загружается один раз,
+    # а изменения записываются в базу пачкой в фоне. Состояние живёт ttl секунд.
+    # При нескольких воркерах вместо памяти процесса используется общее состояние,
+    # иначе ответ на /subscribe может попасть в воркер, который о нём не знает.
+    def __init__(
+        self,
+        config,
+        ttl: int = TTL,
+        flush_delay: float = FLUSH_DELAY,
+        prefix: str = "state",
+    ) -> None:
+        self.config = config
+        self.prefix = prefix
+        self.ttl = ttl
+        self.flush_delay = flush_delay
+        # Последние max_cached чатов, включая пустые состояния незнакомых чатов
+        self.max_cached = MAX_CACHED
+        self.cache: OrderedDict[int, tuple] = OrderedDict()
+        self.dirty: set[int] = set()
+        self.task: asyncio.Task = None
+
+    def key(self, chat_id: int) -> str:
+        return f"{self.prefix}_{chat_id}"
+
+    async def lookup(self, chat_id: int) -> tuple:
+        if is_shared():
+            entry = await get_shared_state().get("chat_" + self.key(chat_id))
+            return tuple(entry) if entry else None
+        if chat_id in self.cache:
+            self.cache.move_to_end(chat_id)
+        return self.cache.get(chat_id)
+
+    async def store(self, chat_id: int, entry: tuple) -> None:
+        if is_shared():
+            await get_shared_state().set("chat_" + self.key(chat_id), entry, self.ttl)
+        else:
+            self.cache[chat_id] = entry
+            self.cache.move_to_end(chat_id)
+            self.trim()
+
+    def trim(self) -> None:
+        # Сначала вытесняются пустые и истёкшие состояния, потом самые старые.
+        # Ещё не записанные в базу состояния не вытесняются
+        if len(self.cache) <= self.max_cached:
+            return
+        now = time()
+        for chat_id, (value, expires) in list(self.cache.items()):
+            if chat_id not in self.dirty and (value is None or expires < now):
+                del self.cache[chat_id]
+        for chat_id in list(self.cache):
+            if len(self.cache) <= self.max_cached:
+                break
+            if chat_id not in self.dirty:
+                del self.cache[chat_id]
+
+    async def get(self, chat_id: int):
+        entry = await self.lookup(chat_id)
+        if entry is None:
+            doc = await self.config.get(self.key(chat_id))
+            if doc:
+                entry = (doc["value"], doc.get("__expires", time() + self.ttl))
+            else:
+                entry = (None, 0)
+            await self.store(chat_id, entry)
+        value, expires = entry
+        if value is not None and expires < time():
+            await self.store(chat_id, (None, 0))
+            return None
+        return value
+
+    async def set(self, chat_id: int, value) -> None:
+        if value is None:
+            entry = await self.lookup(chat_id)
+            if entry is not None and entry[0] is None:
+                return
+        await self.store(chat_id, (value, int(time()) + self.ttl))
+        self.dirty.add(chat_id)
+        if self.task is None:
+            self.task = asyncio.create_task(self.flush_later())
+
+    async def clear(self, chat_id: int) -> None:
+        await self.set(chat_id, None)
+
+    async def flush_later(self) -> None:
+        clear_deadline()
+        await asyncio.sleep(self.flush_delay)
+        try:
+            await self.flush()
+        except Exception as e:
+            print("State flush failed:", e)
+
+    async def flush(self) -> None:
+        self.task = None
+        dirty, self.dirty = self.dirty, set()
+        items = []
+        for chat_id in dirty:
+            # Записывается последнее значение, в том числе от других воркеров
+            value, expires = await self.lookup(chat_id) or (None, 0)
+            items.append(
+                {"key": self.key(chat_id), "value": value, "__expires": expires}
+            )
+        # https://deta.space/docs/en/build/reference/http-api/base#put-items
+        for i in range(0, len(items), 25):
+            await self.config.put(items[i : i + 25])
@@ -1,20 +1,50 @@
 import asyncio
-from os import getenv, environ
+import hashlib
+from os import getenv
 from pprint import pprint
-import json
-from functools import partial
 from time import time
 
-from aiohttp import ClientResponse
+from aiohttp import ClientResponse, FormData
 from fastapi import Request
 
 from main import twitch
+from codec import dumps, dumps_text, loads, read_json
 from detabase import Base
-from utils import escape_symbols, get, get_session, format_text
+from digest import Digest
+from entities import shift, utf16_len
+from lease import Lease
+from lifecycle import lifecycle
+from live import LiveMessages
+from outbox import CLAIM, Outbox
+from resilience import breakers, clear_deadline
+from router import Router
+from scheduler import jitter
+from shared import get_timestamp, set_timestamp
+from state import StateStore
+from thumbnail import Thumbnails
+from timeline import format_duration
+from twitch import history
+from utils import (
+    MAX_MESSAGE_LENGTH,
+    escape_symbols,
+    format_text,
+    get,
+    get_session,
+    join_limited,
+    parse_logins,
+)
+from validation import telegram_secret_token, verify_telegram
 
 config = Base(
     "dev_config" if "ngrok" in getenv("DETA_SPACE_APP_HOSTNAME") else "config"
 )
+MAX_DOCUMENT_SIZE = 64 * 1024
+# Загрузка превью до 10 МБ может занять время
+TIMEOUT = 30
+# Журнал уведомлений переживает перезапуск, только если Outbox_Path указывает
+# на постоянный диск. /tmp на Deta Space очищается, поэтому без Outbox_Path журнал
+# честно живёт в памяти процесса
+OUTBOX_PATH = ":memory:"
 
 
 class Telegram:
@@ -23,6 +53,20 @@ class Telegram:
         self.token = token
         self.base_url = f"https://api.telegram.org/bot{self.token}"
         self.session = None
+        self.thumbnails = Thumbnails()
+        self.router = self.build_router()
+        self.states = StateStore(config)
+        self.pending = StateStore(config, prefix="bulk")
+        self.digest = Digest(
+            self.deliver, self.deliver_many, float(get("Digest_Window") or 0)
+        )
+        self.live = LiveMessages(self.edit_live)
+        # Захват записи должен пережить окно дайджеста
+        self.outbox = Outbox(
+            self.dispatch,
+            get("Outbox_Path") or OUTBOX_PATH,
+            claim=self.digest.window + CLAIM,
+        )
 
     def get_telegram_token(self) -> bool:
         self.token = get("Telegram_Token")
@@ -31,51 +75,66 @@ class Telegram:
 
     async def is_subscribed(self) -> bool:
         # https://core.telegram.org/bots/api#getwebhookinfo
+        # Telegram не возвращает secret_token, поэтому отпечаток хранится у нас
+        if not await self.has_secret_token():
+            return False
         response = await self.make_api_request("GET", "getWebhookInfo")
-        json = await response.json()
+        json = await read_json(response)
         return bool(json["result"]["url"])
 
+    async def has_secret_token(self) -> bool:
+        fingerprint = await get_timestamp(config, "telegram_secret_token", 0)
+        return fingerprint == self.secret_fingerprint()
+
+    @staticmethod
+    def secret_fingerprint() -> int:
+        digest = hashlib.sha256(telegram_secret_token().encode()).hexdigest()
+        return int(digest[:12], 16)
+
     async def subscribe(self) -> bool:
         # https://core.telegram.org/bots/api#setwebhook
         if not self.token and not self.get_telegram_token():
             return False
         elif (
             time()
-            - int(
-                getenv(
-                    "telegram_since_last_check",
-                    (
-                        await config.get(
-                            "telegram_since_last_check", {"value": int(time()) - 14401}
-                        )
-                    )["value"],
-                )
+            - await get_timestamp(
+                config, "telegram_since_last_check", int(time()) - 14401
             )
-        ) < 14400:
+        ) < jitter(14400) and await self.has_secret_token():
             return True
-        elif await self.is_subscribed():
-            await config.put({"key": "telegram_since_last_check", "value": int(time())})
-            environ["telegram_since_last_check"] = str(int(time()))
+        async with Lease(config, "telegram_check") as lease:
+            if not lease.acquired:
+                return True
+            return await self.set_webhook()
+
+    async def set_webhook(self):
+        if await self.is_subscribed():
+            await set_timestamp(config, "telegram_since_last_check", int(time()))
             return True
         response = await self.make_api_request(
             "GET",
             "setWebHook",
             params={
-                "url": f"https://{getenv('DETA_SPACE_APP_HOSTNAME')}/telegramwebhook"
+                "url": f"https://{getenv('DETA_SPACE_APP_HOSTNAME')}/telegramwebhook",
+                "secret_token": telegram_secret_token(),
             },
         )
         await self.set_commands()
-        await config.put({"key": "telegram_since_last_check", "value": int(time())})
-        environ["telegram_since_last_check"] = str(int(time()))
-        return await response.json()
+        await set_timestamp(config, "telegram_since_last_check", int(time()))
+        if response.status == 200:
+            await set_timestamp(
+                config, "telegram_secret_token", self.secret_fingerprint()
+            )
+        return await read_json(response)
 
     async def send_message(
         self,
         chat_id: int,
         text: str,
         *,
-        photo: str = None,
+        photo: str | bytes = None,
         parse_mode: str = None,
+        entities: list = None,
         disable_web_page_preview: bool = False,
         disable_notification: bool = False,
         reply_markup: dict = None,
@@ -90,6 +149,9 @@ class Telegram:
             json["text"] = text
         if parse_mode:
             json["parse_mode"] = parse_mode
+        if entities:
+            # https://core.telegram.org/bots/api#messageentity
+            json["caption_entities" if photo else "entities"] = entities
         if disable_web_page_preview:
             json["disable_web_page_preview"] = disable_web_page_preview
         if disable_notification:
@@ -103,6 +165,13 @@ class Telegram:
                 "sendMessage",
                 json=json,
             )
+        elif isinstance(photo, bytes):
+            # https://core.telegram.org/bots/api#sending-files
+            response = await self.make_api_request(
+                "POST",
+                "sendPhoto",
+                data=self.make_form_data(json),
+            )
         else:
             # https://core.telegram.org/bots/api#sendphoto
             response = await self.make_api_request(
@@ -110,9 +179,206 @@ class Telegram:
                 "sendPhoto",
                 json=json,
             )
-        json = await response.json()
+        json = await read_json(response)
+        if not json["ok"]:
+            pprint(json)
+        return json
+
+    async def send_thumbnail(
+        self, chat_id: int, text: str, login: str, key: str, **kwargs
+    ):
+        # Превью скачивается один раз на событие и загружается в Telegram,
+        # дальше для этого события отправляется только file_id.
+        async with self.thumbnails.lock(key):
+            file_id = await self.thumbnails.get_file_id(key)
+            if file_id:
+                json = await self.send_message(chat_id, text, photo=file_id, **kwargs)
+                if json and json["ok"]:
+                    return json
+                await self.thumbnails.forget(key)
+            photo = await self.thumbnails.download(login, key)
+            if photo:
+                json = await self.send_message(chat_id, text, photo=photo, **kwargs)
+                if json and json["ok"]:
+                    await self.thumbnails.set_file_id(
+                        key, json["result"]["photo"][-1]["file_id"]
+                    )
+                    return json
+        # Картинку не удалось получить или загрузить, отправляем только текст
+        return await self.send_message(chat_id, text, **kwargs)
+
+    async def notify(
+        self,
+        chat_id: int,
+        text: str,
+        *,
+        login: str = None,
+        key: str = None,
+        live: dict = None,
+        **kwargs,
+    ):
+        # Уведомление о событии на канале. Если передан login, к нему прикладывается превью стрима.
+        # Уведомление сначала записывается в журнал, отправляет его воркер outbox.
+        # live - канал и стрим, для которых запоминается отправленное сообщение.
+        item = {"text": text, "login": login, "key": key, "kwargs": kwargs}
+        if live:
+            item["live"] = live
+        return self.outbox.add(chat_id, item)
+
+    async def dispatch(self, chat_id: int, item: dict):
+        # При остановке процесса дайджест уже не копится
+        if self.digest.window and lifecycle.accepting:
+            return await self.digest.add(chat_id, item)
+        return await self.deliver(chat_id, item)
+
+    async def deliver(self, chat_id: int, item: dict):
+        try:
+            json = await self.send_item(chat_id, item)
+        except Exception as e:
+            print("Notification failed:", e)
+            await self.outbox.settle([item], None, str(e))
+            return None
+        await self.outbox.settle([item], json)
+        if item.get("live") and json and json["ok"]:
+            await self.remember_live(item["live"], json["result"])
+        return json
+
+    async def remember_live(self, live: dict, message: dict) -> None:
+        await config.update(
+            live["id"],
+            set={
+                "live_status": {
+                    "stream_id": live["stream_id"],
+                    "chat_id": message["chat"]["id"],
+                    "message_id": message["message_id"],
+                    "photo": "photo" in message,
+                }
+            },
+        )
+
+    async def edit_live(self, record: dict, text: str, entities: list):
+        if record["photo"]:
+            return await self.edit_caption(
+                record["chat_id"], record["message_id"], text, entities=entities
+            )
+        return await self.edit_message(
+            record["chat_id"], record["message_id"], text, entities=entities
+        )
+
+    async def deliver_many(self, chat_id: int, items: list[dict]):
+        try:
+            json = await self.send_items(chat_id, items)
+        except Exception as e:
+            print("Notifications failed:", e)
+            await self.outbox.settle(items, None, str(e))
+            return None
+        await self.outbox.settle(items, json)
+        return json
+
+    async def send_item(self, chat_id: int, item: dict):
+        if item["login"]:
+            return await self.send_thumbnail(
+                chat_id, item["text"], item["login"], item["key"], **item["kwargs"]
+            )
+        return await self.send_message(chat_id, item["text"], **item["kwargs"])
+
+    async def send_items(self, chat_id: int, items: list[dict]):
+        # Возвращает первый неудачный ответ, чтобы всю пачку отправили повторно
+        if not all(item["login"] for item in items):
+            return await self.send_combined(chat_id, items)
+        json = None
+        for i in range(0, len(items), 10):
+            chunk = items[i : i + 10]
+            if len(chunk) == 1:
+                json = await self.send_item(chat_id, chunk[0])
+            else:
+                json = await self.send_media_group(chat_id, chunk)
+                if not json or not json["ok"]:
+                    json = await self.send_combined(chat_id, chunk)
+            if not json or not json["ok"]:
+                return json
+        return json
+
+    async def send_combined(self, chat_id: int, items: list[dict]):
+        # Все уведомления одним сообщением, с разбиением по лимиту в 4096 символов
+        kwargs = {
+            "parse_mode": items[0]["kwargs"].get("parse_mode"),
+            "disable_web_page_preview": all(
+                item["kwargs"].get("disable_web_page_preview") for item in items
+            ),
+            "disable_notification": all(
+                item["kwargs"].get("disable_notification") for item in items
+            ),
+        }
+        text = ""
+        entities = []
+        for item in items:
+            if text and len(text) + len(item["text"]) + 2 > 4096:
+                json = await self.send_message(
+                    chat_id, text, entities=entities, **kwargs
+                )
+                if not json or not json["ok"]:
+                    return json
+                text = ""
+                entities = []
+            text += "\n\n" if text else ""
+            entities += shift(item["kwargs"].get("entities") or [], utf16_len(text))
+            text += item["text"]
+        if text:
+            return await self.send_message(chat_id, text, entities=entities, **kwargs)
+
+    async def send_media_group(self, chat_id: int, items: list[dict]):
+        # https://core.telegram.org/bots/api#sendmediagroup
+        media = []
+        files = {}
+        for i, item in enumerate(items):
+            photo = await self.thumbnails.get_file_id(item["key"])
+            if not photo:
+                content = await self.thumbnails.download(item["login"], item["key"])
+                if not content:
+                    return None
+                files[f"photo{i}"] = content
+                photo = f"attach://photo{i}"
+            media.append({"type": "photo", "media": photo, "caption": item["text"]})
+            if item["kwargs"].get("parse_mode"):
+                media[-1]["parse_mode"] = item["kwargs"]["parse_mode"]
+            if item["kwargs"].get("entities"):
+                media[-1]["caption_entities"] = item["kwargs"]["entities"]
+        json = {"chat_id": chat_id, "media": media}
+        if all(item["kwargs"].get("disable_notification") for item in items):
+            json["disable_notification"] = True
+        if files:
+            json.update(files)
+            response = await self.make_api_request(
+                "POST", "sendMediaGroup", data=self.make_form_data(json)
+            )
+        else:
+            response = await self.make_api_request("POST", "sendMediaGroup", json=json)
+        json = await read_json(response)
         if not json["ok"]:
             pprint(json)
+            return json
+        for item, message in zip(items, json["result"]):
+            await self.thumbnails.set_file_id(
+                item["key"], message["photo"][-1]["file_id"]
+            )
+        return json
+
+    @staticmethod
+    def make_form_data(fields: dict) -> FormData:
+        data = FormData()
+        for name, value in fields.items():
+            if isinstance(value, bytes):
+                data.add_field(
+                    name, value, filename=f"{name}.jpg", content_type="image/jpeg"
+                )
+            elif isinstance(value, (dict, list)):
+                data.add_field(name, dumps_text(value))
+            elif isinstance(value, bool):
+                data.add_field(name, "true" if value else "false")
+            else:
+                data.add_field(name, str(value))
+        return data
 
     async def edit_message(
         self,
@@ -121,6 +387,7 @@ class Telegram:
         text: str,
         *,
         parse_mode: str = None,
+        entities: list = None,
         disable_web_page_preview: bool = False,
         disable_notification: bool = False,
         reply_markup: dict = None,
@@ -129,6 +396,8 @@ class Telegram:
         json = {"chat_id": chat_id, "message_id": message_id, "text": text}
         if parse_mode:
             json["parse_mode"] = parse_mode
+        if entities:
+            json["entities"] = entities
         if disable_web_page_preview:
             json["disable_web_page_preview"] = disable_web_page_preview
         if disable_notification:
@@ -140,9 +409,38 @@ class Telegram:
             "editMessageText",
             json=json,
         )
-        json = await response.json()
+        json = await read_json(response)
         if not json["ok"]:
             pprint(json)
+        return json
+
+    async def edit_caption(
+        self,
+        chat_id: int,
+        message_id: int,
+        caption: str,
+        *,
+        parse_mode: str = None,
+        entities: list = None,
+        reply_markup: dict = None,
+    ):
+        # https://core.telegram.org/bots/api#editmessagecaption
+        json = {"chat_id": chat_id, "message_id": message_id, "caption": caption}
+        if parse_mode:
+            json["parse_mode"] = parse_mode
+        if entities:
+            json["caption_entities"] = entities
+        if reply_markup:
+            json["reply_markup"] = reply_markup
+        response = await self.make_api_request(
+            "POST",
+            "editMessageCaption",
+            json=json,
+        )
+        json = await read_json(response)
+        if not json["ok"]:
+            pprint(json)
+        return json
 
     async def set_commands(self) -> None:
         # https://core.telegram.org/bots/api#setmycommands
@@ -174,6 +472,10 @@ class Telegram:
                         "command": "subscriptions",
                         "description": "Пишет список ваших подписок",
                     },
+                    {
+                        "command": "stats",
+                        "description": "Статистика стримов за последние N дней (по умолчанию 30).",
+                    },
                 ]
             },
         )
@@ -228,63 +530,83 @@ class Telegram:
             inline_keyboard.append(row)
         return {"inline_keyboard": inline_keyboard}
 
+    def build_router(self) -> Router:
+        router = Router()
+        router.command("id", self.id, "chat_id", private=False)
+        router.command("start", self.start, "chat_id", private=False)
+        router.command("help", self.start, "chat_id", private=False)
+        router.command("subscribe", self.command_subscribe, "chat_id", "text")
+        router.command("unsubscribe", self.command_unsubscribe, "chat_id", "text")
+        router.command("check_subscriptions", self.recheck_subscribe, "chat_id")
+        router.command("settings", self.settings, "chat_id")
+        router.command("live", self.live, "event")
+        router.command("subscriptions", self.get_subscriptions, "chat_id")
+        router.command("stats", self.stats, "chat_id", "text")
+        router.state("subscribe", self.command_subscribe, "chat_id", "text", "state")
+        router.state("unsubscribe", self.command_unsubscribe, "chat_id", "text", "state")
+        router.callback("y_", self.correct_user, "event")
+        router.callback("bulk_y", self.callback_bulk_subscribe, "event", "chat_id")
+        router.callback("no", self.wrong_user, "event", "state")
+        router.callback("us_", self.callback_unsubscribe, "event")
+        router.callback("cancel", self.cancel, "event")
+        router.callback("change_message_format", self.change_message_format, "event")
+        router.callback("cmf_", self.callback_change_message_format, "event")
+        router.callback("live_", self.callback_live, "event")
+        router.callback("live", self.live, "event")
+        router.callback("clear", self.clear, "event")
+        return router
+
     async def process_event(self, request: Request) -> None:
         # https://core.telegram.org/bots/api#update
-        event = await request.json()
-        state = (await config.get("state", {"value": None}))["value"]
+        # Запросы без нашего secret_token отбрасываются до разбора тела
+        if not verify_telegram(request.headers):
+            return
+        event = loads(await request.body())
         if "message" in event and "text" in event["message"]:
             # Command
             text: str = event["message"]["text"].lower()
             chat_id: int = event["message"]["chat"]["id"]
-            GLOBAL_COMMANDS = {
-                "id": partial(self.id, chat_id),
-                "start": partial(self.start, chat_id),
-                "help": partial(self.start, chat_id),
-            }
-            PRIVATE_COMMANDS = {
-                "subscribe": partial(self.command_subscribe, chat_id, text, None),
-                "unsubscribe": partial(self.command_unsubscribe, chat_id, text, None),
-                "check_subscriptions": partial(self.recheck_subscribe, chat_id),
-                "settings": partial(self.settings, chat_id),
-                "live": partial(self.live, event),
-                "subscriptions": partial(self.get_subscriptions, chat_id),
-            }
-            STATE = {
-                "subscribe": partial(self.command_subscribe, chat_id, text, state),
-                "unsubscribe": partial(self.command_unsubscribe, chat_id, text, state),
-            }
+            state = await self.states.get(chat_id)
+            values = {"chat_id": chat_id, "text": text, "event": event, "state": state}
             command = text.split()[0].strip("/") if text.startswith("/") else None
-            if command in GLOBAL_COMMANDS:
+            route = self.router.commands.get(command)
+            if route and not route.private:
                 if state:
-                    await config.put({"key": "subscribe", "value": None})
-                return await GLOBAL_COMMANDS[command]()
+                    await self.states.clear(chat_id)
+                return await self.router.dispatch(route, values, self.states.get)
             elif str(chat_id) != getenv("Telegram_Id"):
                 await self.send_message(
                     chat_id,
                     "Вы не авторизованы использовать этого бота.\n\nЕсли вы являетесь создателем этого бота, то убедитесь что вставили ID своего аккаунта в поле Telegram_Id.\n\nЧтобы узнать свой ID используйте команду /id",
                 )
-            elif command in PRIVATE_COMMANDS:
+            elif route:
                 if state:
-                    await config.put({"key": "subscribe", "value": None})
-                return await PRIVATE_COMMANDS[command]()
-            elif state:
-                return await STATE[state]()
+                    await self.states.clear(chat_id)
+                return await self.router.dispatch(route, values, self.states.get)
+            elif state in self.router.states:
+                return await self.router.dispatch(
+                    self.router.states[state], values, self.states.get
+                )
+        elif "message" in event and "document" in event["message"]:
+            # Файл со списком каналов
+            chat_id: int = event["message"]["chat"]["id"]
+            caption: str = event["message"].get("caption", "").lower()
+            if str(chat_id) != getenv("Telegram_Id"):
+                return
+            if (
+                caption.startswith("/subscribe")
+                or await self.states.get(chat_id) == "subscribe"
+            ):
+                return await self.command_subscribe_file(chat_id, event)
         elif "callback_query" in event:
             # Callback (keyboard button)
-            CALLBACK = {
-                "y_": self.correct_user,
-                "no": self.wrong_user,
-                "us_": self.callback_unsubscribe,
-                "cancel": self.cancel,
-                "change_message_format": self.change_message_format,
-                "cmf_": self.callback_change_message_format,
-                "live_": self.callback_live,
-                "live": self.live,
-                "clear": self.clear,
-            }
-            for startswith, func in CALLBACK.items():
-                if event["callback_query"]["data"].startswith(startswith):
-                    return await func(event)
+            route = self.router.get_callback(event["callback_query"]["data"])
+            if route:
+                values = {
+                    "chat_id": event["callback_query"]["message"]["chat"]["id"],
+                    "event": event,
+                }
+                return await self.router.dispatch(route, values, self.states.get)
 
     # Commands
 
@@ -298,6 +620,29 @@ class Telegram:
             text = "У вас нету активных подписок. Чтобы подписаться, воспользуйтесь командой /subscribe"
         await self.send_message(chat_id, text)
 
+    async def stats(self, chat_id: int, text: str):
+        args = text.split()
+        days = int(args[1]) if len(args) > 1 and args[1].isdigit() else 30
+        subscriptions = (await config.get("subscriptions", {"value": []}))["value"]
+        stats = await history.stats([sub["id"] for sub in subscriptions], days)
+        if not stats["sessions"]:
+            await self.send_message(
+                chat_id, f"За последние {days} дн. не было ни одного стрима."
+            )
+            return
+        text = (
+            f"Статистика за последние {days} дн.:\n\n"
+            f"Стримов: {stats['sessions']}\n"
+            f"Всего: {format_duration(stats['total'])}\n"
+            f"Средняя длительность: {format_duration(stats['average'])}\n\n"
+            "Категории:\n"
+            + "\n".join(
+                f"{category} [{format_duration(played)}]"
+                for category, played in list(stats["categories"].items())[:20]
+            )
+        )
+        await self.send_message(chat_id, text)
+
     async def id(self, chat_id: int):
         await self.send_message(
             chat_id, f"Ваш ID: `{chat_id}`", parse_mode="MarkdownV2"
@@ -351,12 +696,12 @@ class Telegram:
                 reply_markup={"inline_keyboard": inline_keyboard},
             )
 
-    async def command_subscribe(self, chat_id: int, text: str, state: str | None):
-        # Добавить возможность подписаться на пачку стримеров.
-        if text.count(" ") != 2 and not state:
+    async def command_subscribe(self, chat_id: int, text: str, state: str = None):
+        logins = parse_logins(text if state else text.partition(" ")[2])
+        if not logins and not state:
             await self.send_message(
                 chat_id,
-                "Отправьте название или ссылку на канал в следующем сообщении.",
+                "Отправьте название или ссылку на канал в следующем сообщении. Можно отправить сразу несколько каналов или файл со списком.",
                 reply_markup={
                     "inline_keyboard": [
                         [
@@ -368,12 +713,13 @@ class Telegram:
                     ]
                 },
             )
-            await config.put({"key": "state", "value": "subscribe"})
+            await self.states.set(chat_id, "subscribe")
+        elif len(logins) > 1:
+            await self.command_bulk_subscribe(chat_id, logins)
+        elif not logins:
+            await self.send_message(chat_id, "Не смог найти такого пользователя.")
         else:
-            username = text.split()[0 if state else 1]
-            if "twitch.tv/" in username:
-                username = username.split(".tv/")[-1].split("?")[0]
-            user = await twitch.get_users(username)
+            user = await twitch.get_users(logins[0])
             if not user:
                 await self.send_message(chat_id, "Не смог найти такого пользователя.")
             else:
@@ -385,7 +731,7 @@ class Telegram:
                     return
                 await self.send_message(
                     chat_id,
-                    f"Это правильный пользователь?\n\n*Логин:* {escape_symbols(user['login'])}\n*Описание:* {escape_symbols(user['description'])}\n\nhttps://twitch\.tv/{escape_symbols(user['login'])}",
+                    f"Это правильный пользователь?\n\n*Логин:* {escape_symbols(user['login'])}\n*Описание:* {escape_symbols(user.get('description', ''))}\n\nhttps://twitch\.tv/{escape_symbols(user['login'])}",
                     parse_mode="MarkdownV2",
                     reply_markup={
                         "inline_keyboard": [
@@ -400,7 +746,75 @@ class Telegram:
                     },
                 )
 
-    async def command_unsubscribe(self, chat_id: int, text: str, state: str | None):
+    async def command_bulk_subscribe(self, chat_id: int, logins: list):
+        users, subscriptions = await asyncio.gather(
+            twitch.get_users_by_login(logins),
+            config.get("subscriptions", {"value": []}),
+        )
+        subscribed = {sub["id"] for sub in subscriptions["value"]}
+        found = {user["login"] for user in users}
+        new = [user for user in users if user["id"] not in subscribed]
+        # Длинный список сокращается, чтобы сообщение влезло в лимит Telegram
+        text = ""
+        if new:
+            text += "Подписаться на эти каналы?\n\n" + join_limited(
+                [f"{user['login']} — twitch.tv/{user['login']}" for user in new],
+                MAX_MESSAGE_LENGTH - 1200,
+            )
+        already = [user["login"] for user in users if user["id"] in subscribed]
+        if already:
+            text += "\n\nУже подписаны: " + join_limited(already, 500, ", ")
+        unknown = [login for login in logins if login not in found]
+        if unknown:
+            text += "\n\nНе смог найти: " + join_limited(unknown, 500, ", ")
+        if not new:
+            await self.send_message(chat_id, text.strip())
+            return
+        await self.pending.set(
+            chat_id, [{"id": user["id"], "login": user["login"]} for user in new]
+        )
+        await self.send_message(
+            chat_id,
+            text.strip(),
+            reply_markup={
+                "inline_keyboard": [
+                    [
+                        {"text": "Да", "callback_data": "bulk_y"},
+                        {"text": "Нет", "callback_data": "clear"},
+                    ]
+                ]
+            },
+        )
+
+    async def command_subscribe_file(self, chat_id: int, event: dict):
+        # Список каналов, отправленный текстовым файлом
+        text = await self.download_document(event["message"]["document"])
+        if text is None:
+            await self.send_message(chat_id, "Не смог прочитать файл.")
+            return
+        await self.command_subscribe(chat_id, text, "subscribe")
+
+    async def download_document(self, document: dict) -> str:
+        # https://core.telegram.org/bots/api#getfile
+        if document.get("file_size", 0) > MAX_DOCUMENT_SIZE:
+            return None
+        response = await self.make_api_request(
+            "GET", "getFile", params={"file_id": document["file_id"]}
+        )
+        json = await read_json(response)
+        if not json["ok"]:
+            return None
+        response = await breakers["telegram"].request(
+            self.session,
+            "GET",
+            f"https://api.telegram.org/file/bot{self.token}/{json['result']['file_path']}",
+            TIMEOUT,
+        )
+        if response.status != 200:
+            return None
+        return (await response.read())[:MAX_DOCUMENT_SIZE].decode(errors="ignore")
+
+    async def command_unsubscribe(self, chat_id: int, text: str, state: str = None):
         if text.count(" ") != 2 and not state:
             await self.send_message(
                 chat_id,
@@ -416,16 +830,18 @@ class Telegram:
                     ]
                 },
             )
-            await config.put({"key": "state", "value": "unsubscribe"})
+            await self.states.set(chat_id, "unsubscribe")
         else:
             login = text.split()[0 if state else 1].lower()
             if "twitch.tv/" in login:
                 login = login.split("twitch.tv/")[1]
             subscriptions = await config.get("subscriptions", {"value": []})
-            user = None
-            for sub in subscriptions["value"]:
-                if login == sub["login"]:
-                    user = sub
+            twitch.users.warm(subscriptions["value"])
+            cached, user = await twitch.users.get_by_login(login)
+            if user and not any(
+                user["id"] == sub["id"] for sub in subscriptions["value"]
+            ):
+                user = None
             if not user:
                 await self.send_message(
                     chat_id, "У вас нету подписки на данного стримера."
@@ -447,10 +863,35 @@ class Telegram:
                 },
             )
 
+    def in_background(self, chat_id: int, coro) -> None:
+        # Долгие действия администратора (полная проверка, подписка списком)
+        # не укладываются в срок вебхука и продолжаются после ответа Telegram
+        async def run():
+            clear_deadline()
+            try:
+                await coro
+            except Exception as e:
+                print("Background action failed:", e)
+                try:
+                    await self.send_message(
+                        chat_id, "Не получилось, попробуйте ещё раз."
+                    )
+                except Exception as report_error:
+                    print("Failure report failed:", report_error)
+
+        lifecycle.spawn(run())
+
     async def recheck_subscribe(self, chat_id: int):
+        self.in_background(chat_id, self.check_all_subscriptions(chat_id))
+
+    async def check_all_subscriptions(self, chat_id: int):
         if twitch.client_id and twitch.client_secret:
             subscribed = await twitch.subscribe(force=True)
-            if subscribed:
+            if subscribed is None:
+                await self.send_message(
+                    chat_id, "Проверка уже идёт в другом экземпляре, попробуйте позже."
+                )
+            elif subscribed:
                 await self.send_message(chat_id, "Переподписался на некоторые каналы.")
             else:
                 await self.send_message(chat_id, "Все подписки работают.")
@@ -519,18 +960,19 @@ class Telegram:
 
     async def correct_user(self, event: dict):
         id: str = event["callback_query"]["data"].split("_")[1]
-        login: str = (
-            event["callback_query"]["message"]["text"]
-            .split("Логин: ")[1]
-            .split("\n")[0]
-        )
         tasks = []
-        subscriptions, global_settings = await config.get_many(
-            ["subscriptions", "global"]
-        )
-        subscriptions = subscriptions["value"] if subscriptions else []
-        subscriptions.append({"id": id, "login": login})
+        subscriptions = (await config.get("subscriptions", {"value": []}))["value"]
         user = (await twitch.combine_channel_data([id]))[id]
+        cached = await twitch.users.get_by_id(id)
+        login: str = cached["login"] if cached else user.get("login")
+        if not login:
+            # Если Helix не ответил, логин берётся из сообщения с вопросом
+            login = (
+                event["callback_query"]["message"]["text"]
+                .split("Логин: ")[1]
+                .split("\n")[0]
+            )
+        subscriptions.append({"id": id, "login": login})
         user.update(
             {
                 "key": id,
@@ -540,14 +982,8 @@ class Telegram:
                 "streamonline": None,
             }
         )
-        user.update(**global_settings)
-        await config.put(
-            [
-                user,
-                {"key": "subscriptions", "value": subscriptions},
-                {"key": "state", "value": None},
-            ]
-        )
+        await self.states.clear(event["callback_query"]["message"]["chat"]["id"])
+        await config.put([user, {"key": "subscriptions", "value": subscriptions}])
         tasks.append(
             asyncio.create_task(
                 self.edit_message(
@@ -590,8 +1026,87 @@ class Telegram:
         )
         await asyncio.gather(*tasks)
 
-    async def wrong_user(self, event: dict):
-        state = (await config.get("state", {"value": None}))["value"]
+    async def callback_bulk_subscribe(self, event: dict, chat_id: int):
+        self.in_background(chat_id, self.bulk_subscribe(event, chat_id))
+
+    async def bulk_subscribe(self, event: dict, chat_id: int):
+        message_id = event["callback_query"]["message"]["message_id"]
+        users = await self.pending.get(chat_id)
+        if not users:
+            await self.edit_message(
+                chat_id, message_id, "Список устарел, отправьте его ещё раз."
+            )
+            return
+        await self.pending.clear(chat_id)
+        await self.states.clear(chat_id)
+        subscriptions = (await config.get("subscriptions", {"value": []}))["value"]
+        subscribed = {sub["id"] for sub in subscriptions}
+        users = [user for user in users if user["id"] not in subscribed]
+        channels = await twitch.combine_channel_data([user["id"] for user in users])
+        items = []
+        for user in users:
+            channel = channels[user["id"]]
+            channel.update(
+                {
+                    "key": user["id"],
+                    "login": user["login"],
+                    "channelupdate": None,
+                    "streamoffline": None,
+                    "streamonline": None,
+                }
+            )
+            items.append(channel)
+            subscriptions.append({"id": user["id"], "login": user["login"]})
+        items.append({"key": "subscriptions", "value": subscriptions})
+        # https://deta.space/docs/en/build/reference/http-api/base#put-items
+        for i in range(0, len(items), 25):
+            await config.put(items[i : i + 25])
+
+        progress = {user["login"]: "⏳" for user in users}
+        last_edit = 0
+        lock = asyncio.Lock()
+
+        async def show_progress(done: bool = False):
+            nonlocal last_edit
+            async with lock:
+                if not done and time() - last_edit < 1:
+                    return
+                last_edit = time()
+                finished = sum(status != "⏳" for status in progress.values())
+                await self.edit_message(
+                    chat_id,
+                    message_id,
+                    ("Готово 👍" if done else "Подписываюсь...")
+                    + f" {finished}/{len(progress)}\n\n"
+                    + join_limited(
+                        [f"{status} {login}" for login, status in progress.items()],
+                        MAX_MESSAGE_LENGTH - 100,
+                    ),
+                )
+
+        # Не больше 10 каналов одновременно, чтобы не упираться в лимиты Helix
+        semaphore = asyncio.Semaphore(10)
+
+        async def create(user: dict):
+            async with semaphore:
+                responses = await asyncio.gather(
+                    *(
+                        twitch.create_eventsub_subscription(type, user["id"])
+                        for type in ("stream.online", "stream.offline", "channel.update")
+                    )
+                )
+            ok = all(
+                response is True or (response and response.status == 202)
+                for response in responses
+            )
+            progress[user["login"]] = "✅" if ok else "❌"
+            await show_progress()
+
+        await show_progress(done=not users)
+        await asyncio.gather(*(create(user) for user in users))
+        await show_progress(done=True)
+
+    async def wrong_user(self, event: dict, state: str):
         await self.edit_message(
             event["callback_query"]["message"]["chat"]["id"],
             event["callback_query"]["message"]["message_id"],
@@ -669,22 +1184,23 @@ class Telegram:
                 },
             )
             return
+        text, entities = format_text(
+            channel,
+            channel,
+            "*Название стрима:* ${title}\n*Стрим идёт:* ${uptime}\n*Категории:* ${categories}\n\n${stream_url}",
+        )
         await self.edit_message(
             event["callback_query"]["message"]["chat"]["id"],
             event["callback_query"]["message"]["message_id"],
-            format_text(
-                channel,
-                channel,
-                "*Название стрима:* ${title}\n*Стрим идёт:* ${uptime}\n*Категории:* ${categories}\n\n${stream_url}",
-            ),
-            parse_mode="MarkdownV2",
+            text,
+            entities=entities,
             reply_markup={
                 "inline_keyboard": [[{"text": "Назад", "callback_data": "live"}]]
             },
         )
 
     async def clear(self, event: dict):
-        await config.put({"key": "state", "value": None})
+        await self.states.clear(event["callback_query"]["message"]["chat"]["id"])
         await self.edit_message(
             event["callback_query"]["message"]["chat"]["id"],
             event["callback_query"]["message"]["message_id"],
@@ -692,7 +1208,7 @@ class Telegram:
         )
 
     async def choose(self, event: dict):
-        data: dict = json.loads(event["callback_query"]["data"].split("_", 1)[-1])
+        data: dict = loads(event["callback_query"]["data"].split("_", 1)[-1])
         online = data["on"]
         offline = data["of"]
         update = data["up"]
@@ -706,22 +1222,22 @@ class Telegram:
                     [
                         {
                             "text": f"Начало стрима",
-                            "callback_data": f"""sb_{json.dumps({"id": data["id"], "on": int(not online), "of": offline, "up": update}).replace(" ", "")}""",
+                            "callback_data": f"""sb_{dumps_text({"id": data["id"], "on": int(not online), "of": offline, "up": update})}""",
                         },
                         {
                             "text": f"Конец стрима",
-                            "callback_data": f"""sb_{json.dumps({"id": data["id"], "on": online, "of": int(not offline), "up": update}).replace(" ", "")}""",
+                            "callback_data": f"""sb_{dumps_text({"id": data["id"], "on": online, "of": int(not offline), "up": update})}""",
                         },
                         {
                             "text": f"Обновление",
-                            "callback_data": f"""sb_{json.dumps({"id": data["id"], "on": online, "of": offline, "up": int(not update)}).replace(" ", "")}""",
+                            "callback_data": f"""sb_{dumps_text({"id": data["id"], "on": online, "of": offline, "up": int(not update)})}""",
                         },
                     ],
                     [
                         {"text": "Отмена", "callback_data": "cancel"},
                         {
                             "text": "Дальше",
-                            "callback_data": f"""cn_{json.dumps(data).replace(" ", "")}""",
+                            "callback_data": f"""cn_{dumps_text(data)}""",
                         },
                     ],
                 ]
@@ -729,10 +1245,17 @@ class Telegram:
         )
 
     async def make_api_request(
-        self, method: str, endpoint: str, *args, **kwargs
+        self, method: str, endpoint: str, **kwargs
     ) -> ClientResponse:
         if self.session is None:
             self.session = await get_session()
-        return await self.session.request(
-            method, f"{self.base_url}/{endpoint}", *args, **kwargs
+        if kwargs.get("json") is not None:
+            kwargs["data"] = dumps(kwargs.pop("json"))
+            kwargs["headers"] = {"Content-Type": "application/json"}
+        return await breakers["telegram"].request(
+            self.session,
+            method,
+            f"{self.base_url}/{endpoint}",
+            TIMEOUT,
+            **kwargs,
         )
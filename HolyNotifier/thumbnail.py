@@ -0,0 +1,113 @@
+import asyncio
+import hashlib
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from time import time
+
+from codec import dumps
+from shared import get_shared_state
+from utils import get_session
+
+# https://core.telegram.org/bots/api#sending-files
+MAX_SIZE = 10 * 1024 * 1024
+MAX_CACHED = 512
+FILE_ID_TTL = 24 * 60 * 60
+PREVIEW_URL = "https://static-cdn.jtvnw.net/previews-ttv/live_user_{login}-1920x1080.jpg"
+
+
+def event_key(data: dict) -> str:
+    # Одно и то же событие (в том числе повторная доставка от Twitch) даёт один и тот же ключ,
+    # поэтому повторная отправка переиспользует уже загруженный file_id.
+    # В channel.update нет ни id, ни времени: возврат к прежним названию и категории
+    # дал бы тот же ключ и старый кадр, поэтому берётся id сообщения EventSub
+    # (при повторной доставке он тот же). stream.online/offline содержат id стрима.
+    source = data["event"]
+    if data["subscription"]["type"] == "channel.update":
+        metadata = data.get("metadata") or {}
+        source = [
+            data["event"],
+            metadata.get("message_id") or metadata.get("message_timestamp") or time(),
+        ]
+    return hashlib.sha1(dumps(source, sort_keys=True)).hexdigest()[:16]
+
+
+class Thumbnails:
+    def __init__(self, max_size: int = MAX_SIZE, max_cached: int = MAX_CACHED) -> None:
+        self.max_size = max_size
+        self.max_cached = max_cached
+        self.file_ids: OrderedDict[str, str] = OrderedDict()
+        # key -> (замок, сколько отправок его держат или ждут)
+        self.locks: dict[str, tuple] = {}
+        self.session = None
+
+    async def get_file_id(self, key: str) -> str:
+        file_id = self.file_ids.get(key)
+        if file_id:
+            self.file_ids.move_to_end(key)
+            return file_id
+        # Картинку могли уже загрузить в другом воркере
+        file_id = await get_shared_state().get("thumbnail_" + key)
+        if file_id:
+            self.remember(key, file_id)
+        return file_id
+
+    async def set_file_id(self, key: str, file_id: str) -> None:
+        self.remember(key, file_id)
+        await get_shared_state().set("thumbnail_" + key, file_id, FILE_ID_TTL)
+
+    def remember(self, key: str, file_id: str) -> None:
+        self.file_ids[key] = file_id
+        self.file_ids.move_to_end(key)
+        while len(self.file_ids) > self.max_cached:
+            self.file_ids.popitem(last=False)
+
+    async def forget(self, key: str) -> None:
+        self.file_ids.pop(key, None)
+        await get_shared_state().delete("thumbnail_" + key)
+
+    @asynccontextmanager
+    async def lock(self, key: str):
+        # Пока первая отправка загружает картинку, остальные ждут её file_id.
+        # Замок удаляется, только когда его больше никто не держит и не ждёт,
+        # иначе новая отправка получила бы другой замок
+        lock, users = self.locks.get(key, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        self.locks[key] = (lock, users + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, users = self.locks[key]
+            if users == 1:
+                del self.locks[key]
+            else:
+                self.locks[key] = (lock, users - 1)
+
+    async def download(self, login: str, key: str) -> bytes:
+        # Параметр t не даёт CDN отдать старый закэшированный кадр
+        if self.session is None:
+            self.session = await get_session()
+        try:
+            response = await self.session.get(
+                PREVIEW_URL.format(login=login),
+                params={"t": key},
+                allow_redirects=False,
+            )
+        except Exception as e:
+            print("Thumbnail download failed:", e)
+            return None
+        async with response:
+            # Если стрим офлайн, Twitch делает редирект на заглушку 404_preview
+            if response.status != 200:
+                return None
+            if not response.headers.get("Content-Type", "").startswith("image/"):
+                return None
+            if int(response.headers.get("Content-Length", 0)) > self.max_size:
+                return None
+            photo = bytearray()
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                photo += chunk
+                if len(photo) > self.max_size:
+                    return None
+        return bytes(photo) or None
@@ -0,0 +1,75 @@
+def format_duration(seconds: float) -> str:
+    # В отличие от time.strftime("%H:%M:%S", time.gmtime(...)) не обнуляется после 24 часов
+    minutes, seconds = divmod(max(int(seconds), 0), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:02}:{minutes:02}:{seconds:02}"
+
+
+class Timeline:
+    # Категории стрима: список отрезков [категория, начало] и сумма времени
+    # по уже закрытым отрезкам. В документе канала хранится как
+    # segments, game_time (суммы), game_timestamp (начало текущего отрезка) и started_at.
+    def __init__(self, started_at: float, segments: list, totals: dict) -> None:
+        self.started_at = started_at
+        self.segments = segments
+        self.totals = totals
+
+    @classmethod
+    def start(cls, category: str, timestamp: float) -> "Timeline":
+        return cls(timestamp, [[category, timestamp]], {})
+
+    @classmethod
+    def from_channel(cls, channel: dict) -> "Timeline":
+        if not channel.get("is_live") or channel.get("started_at") is None:
+            return None
+        segments = channel.get("segments") or [
+            [channel["category"], channel["game_timestamp"] or channel["started_at"]]
+        ]
+        return cls(channel["started_at"], segments, channel.get("game_time") or {})
+
+    @property
+    def current(self) -> str:
+        return self.segments[-1][0]
+
+    @property
+    def current_start(self) -> float:
+        return self.segments[-1][1]
+
+    def switch(self, category: str, timestamp: float) -> None:
+        if category == self.current:
+            return
+        self.totals[self.current] = (
+            self.totals.get(self.current, 0) + timestamp - self.current_start
+        )
+        self.segments.append([category, timestamp])
+
+    def uptime(self, now: float) -> float:
+        return now - self.started_at
+
+    def category_time(self, now: float, category: str = None) -> float:
+        category = self.current if category is None else category
+        played = self.totals.get(category, 0)
+        if category == self.current:
+            played += now - self.current_start
+        return played
+
+    def summary(self, now: float, min_seconds: int = 60) -> str:
+        # Категории, в которых провели меньше минуты, не показываются, если есть другие
+        played = dict(self.totals)
+        played[self.current] = played.get(self.current, 0) + now - self.current_start
+        shown = [
+            f"{category} [{format_duration(seconds)}]"
+            for category, seconds in played.items()
+            if seconds >= min_seconds
+        ]
+        if not shown:
+            shown = [f"{self.current} [{format_duration(played[self.current])}]"]
+        return " | ".join(shown)
+
+    def to_set(self) -> dict:
+        return {
+            "started_at": self.started_at,
+            "game_timestamp": self.current_start,
+            "game_time": self.totals,
+            "segments": self.segments,
+        }
@@ -1,16 +1,30 @@
 import asyncio
-import hashlib
-import hmac
-import json
-from datetime import datetime, timedelta, timezone
 from dateutil.parser import parse
-from os import getenv, environ
+from os import getenv
+from functools import partial
+from operator import itemgetter
 from time import time
 
 from fastapi import Request, Response
 
+from codec import DecodeError, dumps, loads, read_json
+from debounce import Debouncer
+from entities import shift, utf16_len
 from detabase import Base
+from history import History
+from loader import Loader
+from lease import Lease
+from poller import Poller
+from resilience import DeadlineExceeded, UpstreamError, breakers, remaining
+from scheduler import Scheduler
+from settings import Settings
+from shared import get_shared_state, set_timestamp
+from sharding import Sharding
+from thumbnail import event_key
+from timeline import Timeline
+from users import UserCache
 from utils import get, get_session, format_text
+from validation import verify_twitch
 
 config = Base(
     "dev_config" if "ngrok" in getenv("DETA_SPACE_APP_HOSTNAME") else "config"
@@ -22,28 +36,53 @@ async def stream_online(data: dict):
     global telegram
     if "telegram" not in globals():
         from main import telegram
-    channel = await config.get(data["event"]["broadcaster_user_id"])
-    await telegram.send_message(
-        get("Telegram_Id"),
-        format_text(
-            channel,
-            data,
-            channel["message"]["stream.online"],
-        ),
-        parse_mode="MarkdownV2",
-        photo=f"https://static-cdn.jtvnw.net/previews-ttv/live_user_{channel['login']}-1920x1080.jpg"
-        if channel["screenshot"]["stream.online"]
-        else None,
+    # Один и тот же стрим может прийти и вебхуком, и из опроса Helix
+    key = "online_" + data["event"]["id"]
+    if not await get_shared_state().add_once(key, 12 * 60 * 60):
+        return
+    try:
+        await announce_online(data)
+    except Exception:
+        # Ключ освобождается, чтобы повтор от Twitch или опрос Helix
+        # обработали событие ещё раз
+        await get_shared_state().delete(key)
+        raise
+
+
+async def announce_online(data: dict):
+    channel = await settings.effective(
+        await config.get(data["event"]["broadcaster_user_id"])
+    )
+    if channel["is_live"] and channel.get("stream_id") == data["event"]["id"]:
+        return
+    text, entities = format_text(
+        channel,
+        data,
+        channel["message"]["stream.online"],
+    )
+    kwargs = dict(
+        entities=entities,
         disable_web_page_preview=channel["disable_preview"]["stream.online"],
         disable_notification=channel["disable_notifications"]["stream.online"],
     )
+    if channel["screenshot"]["stream.online"]:
+        kwargs.update(login=channel["login"], key=event_key(data))
+    if channel.get("live_message"):
+        # Это сообщение потом будет редактироваться при изменениях на канале
+        kwargs.update(
+            live={
+                "id": data["event"]["broadcaster_user_id"],
+                "stream_id": data["event"]["id"],
+            }
+        )
+    await telegram.notify(get("Telegram_Id"), text, **kwargs)
     await config.update(
         data["event"]["broadcaster_user_id"],
         set={
             "is_live": True,
-            "started_at": int(time()),
-            "game_timestamp": int(time()),
-            "game_time": {},
+            "stream_id": data["event"]["id"],
+            "titles": [[int(time()), channel["title"]]],
+            **Timeline.start(channel["category"], int(time())).to_set(),
         },
     )
 
@@ -53,79 +92,179 @@ async def stream_offline(data: dict):
     global telegram
     if "telegram" not in globals():
         from main import telegram
-    channel = await config.get(data["event"]["broadcaster_user_id"])
-    await telegram.send_message(
-        get("Telegram_Id"),
-        format_text(
-            channel,
-            data,
-            channel["message"]["stream.offline"],
-        ),
-        parse_mode="MarkdownV2",
-        disable_web_page_preview=channel["disable_preview"]["stream.offline"],
-        disable_notification=channel["disable_notifications"]["stream.offline"],
+    await debouncer.flush(data["event"]["broadcaster_user_id"])
+    channel = await settings.effective(
+        await config.get(data["event"]["broadcaster_user_id"])
     )
+    key = f"offline_{channel['key']}_{channel['started_at']}"
+    if not channel["is_live"] or not await get_shared_state().add_once(
+        key, 12 * 60 * 60
+    ):
+        return
+    try:
+        await announce_offline(data, channel)
+    except Exception:
+        await get_shared_state().delete(key)
+        raise
+
+
+async def announce_offline(data: dict, channel: dict):
+    end = int(time())
+    text, entities = format_text(
+        channel,
+        data,
+        channel["message"]["stream.offline"],
+    )
+    record = get_live_message(channel)
+    if record:
+        # Сообщение о стриме дополняется итогом вместо нового сообщения
+        live_text, live_entities = format_text(
+            channel, data, channel["message"]["stream.online"]
+        )
+        offset = utf16_len(live_text + "\n\n")
+        try:
+            json = await telegram.live.finish(
+                data["event"]["broadcaster_user_id"],
+                record,
+                live_text + "\n\n" + text,
+                live_entities + shift(entities, offset),
+            )
+        except Exception as e:
+            # Если правка не прошла, итог уходит обычным уведомлением
+            print("Live message finish failed:", e)
+            json = None
+        if json and json["ok"]:
+            text = None
+    if text is not None:
+        await telegram.notify(
+            get("Telegram_Id"),
+            text,
+            entities=entities,
+            disable_web_page_preview=channel["disable_preview"]["stream.offline"],
+            disable_notification=channel["disable_notifications"]["stream.offline"],
+        )
+    # Журнал пишется после уведомления: ошибка Deta не должна его задерживать
+    try:
+        await history.append(data["event"]["broadcaster_user_id"], channel, end)
+    except Exception as e:
+        print("History append failed:", e)
     await config.update(
         data["event"]["broadcaster_user_id"],
         set={
             "is_live": False,
+            "stream_id": None,
             "started_at": None,
             "game_timestamp": None,
             "game_time": {},
+            "segments": [],
+            "titles": [],
+            "live_status": None,
         },
     )
 
 
+def get_live_message(channel: dict) -> dict:
+    # Сообщение, которое можно редактировать, если оно отправлено для текущего стрима
+    record = channel.get("live_status")
+    if (
+        isinstance(record, dict)
+        and channel["is_live"]
+        and record["stream_id"] == channel.get("stream_id")
+    ):
+        return record
+    return None
+
+
 async def channel_update(data: dict):
     # https://dev.twitch.tv/docs/eventsub/eventsub-subscription-types/#channelupdate
+    channel = await settings.effective(
+        await config.get(data["event"]["broadcaster_user_id"])
+    )
+    window = (channel.get("debounce") or {}).get("channel.update", 0)
+    if window:
+        # Несколько изменений подряд превращаются в одно уведомление
+        await debouncer.add(
+            data["event"]["broadcaster_user_id"], window, channel, (int(time()), data)
+        )
+        return
+    await send_channel_update(
+        data["event"]["broadcaster_user_id"], channel, [(int(time()), data)]
+    )
+
+
+def apply_channel_update(channel: dict, event: dict, timestamp: int) -> dict:
+    # Переносит изменение в channel, засчитывая время предыдущей категории
+    set = {}
+    if (
+        any((channel["category"], event["category_name"]))
+        and channel["category"] != event["category_name"]
+    ):
+        timeline = Timeline.from_channel(channel)
+        if timeline:
+            timeline.switch(event["category_name"], timestamp)
+            channel.update(timeline.to_set())
+            set.update(timeline.to_set())
+        channel["category"] = event["category_name"]
+        set["category"] = event["category_name"]
+    if channel["title"] != event["title"]:
+        channel["title"] = event["title"]
+        set["title"] = event["title"]
+        if channel["is_live"]:
+            channel["titles"] = (channel.get("titles") or []) + [
+                [timestamp, event["title"]]
+            ]
+            set["titles"] = channel["titles"]
+    return set
+
+
+async def send_channel_update(broadcaster_user_id: str, channel: dict, updates: list):
     global telegram
     if "telegram" not in globals():
         from main import telegram
+    original = {"title": channel["title"], "category": channel["category"]}
     set = {}
-    channel = await config.get(data["event"]["broadcaster_user_id"])
+    for timestamp, data in updates:
+        set.update(apply_channel_update(channel, data["event"], timestamp))
     if (
-        not any((channel["category"], data["event"]["category_name"]))
-        and channel["category"] == data["event"]["category_name"]
-    ) and channel["title"] == data["event"]["title"]:
+        not any((original["category"], data["event"]["category_name"]))
+        and original["category"] == data["event"]["category_name"]
+    ) and original["title"] == data["event"]["title"]:
+        if set:
+            await config.update(broadcaster_user_id, set=set)
         return
-    if (
-        any((channel["category"], data["event"]["category_name"]))
-        and channel["category"] != data["event"]["category_name"]
-    ):
-        if channel["is_live"]:
-            if not channel["game_time"]:
-                channel["game_time"] = {
-                    channel["category"]: int(time()) - channel["game_timestamp"]
-                }
-            elif channel["category"] not in channel["game_time"]:
-                channel["game_time"][channel["category"]] = (
-                    int(time()) - channel["game_timestamp"]
-                )
-            else:
-                channel["game_time"][channel["category"]] += (
-                    int(time()) - channel["game_timestamp"]
-                )
-            set["game_time"] = channel["game_time"]
-            set["game_timestamp"] = int(time())
-        set["category"] = data["event"]["category_name"]
-    if channel["title"] != data["event"]["title"]:
-        set["title"] = data["event"]["title"]
-    await telegram.send_message(
-        get("Telegram_Id"),
-        format_text(channel, data, channel["message"]["channel.update"]),
-        parse_mode="MarkdownV2",
-        photo=f"https://static-cdn.jtvnw.net/previews-ttv/live_user_{channel['login']}-1920x1080.jpg"
-        if channel["screenshot"]["channel.update"] and channel["is_live"]
-        else None,
+    # Изменения сохраняются до отправки, чтобы ошибка Telegram их не потеряла
+    await config.update(broadcaster_user_id, set=set)
+    record = get_live_message(channel)
+    if record:
+        # Изменения показываются в сообщении о начале стрима
+        text, entities = format_text(channel, data, channel["message"]["stream.online"])
+        try:
+            await telegram.live.update(broadcaster_user_id, record, text, entities)
+            return
+        except Exception as e:
+            # Если правка не прошла, изменения уходят обычным уведомлением
+            print("Live message update failed:", e)
+    # В тексте сравнивается старое название и категория с последними из пачки
+    text, entities = format_text(
+        dict(channel, **original), data, channel["message"]["channel.update"]
+    )
+    kwargs = dict(
+        entities=entities,
         disable_web_page_preview=channel["disable_preview"]["channel.update"],
         disable_notification=channel["disable_notifications"]["channel.update"],
     )
-    await config.update(
-        data["event"]["broadcaster_user_id"],
-        set=set,
-    )
+    if channel["screenshot"]["channel.update"] and channel["is_live"]:
+        kwargs.update(login=channel["login"], key=event_key(data))
+    await telegram.notify(get("Telegram_Id"), text, **kwargs)
+
 
+debouncer = Debouncer(send_channel_update)
+history = History(config)
+settings = Settings(config)
 
+
+COST_WARNING = 0.9
+HELIX_TIMEOUT = 10
 VERSION = {"channel.update": "2", "stream.online": "1", "stream.offline": "1"}
 EVENTS = {
     "stream.online": stream_online,
@@ -141,71 +280,91 @@ class Twitch:
         self.expires = 0
         self.headers = {"Client-Id": client_id, "Authorization": None}
         self.session = None
-        self.content_classification_labels: list = None
+        self.users = UserCache()
+        self.eventsub_cost: dict = None
+        self.sharding = Sharding(self, config, get("Shard_Url"))
+        self.poller = Poller(
+            self, config, history, EVENTS, float(get("Poll_Interval") or 0)
+        )
+        self.scheduler = Scheduler(self, config)
+        # Одновременные запросы к Helix объединяются в пачки
+        self.stream_loader = Loader(
+            partial(self.get_batch, "https://api.twitch.tv/helix/streams", "user_id"),
+            itemgetter("user_id"),
+        )
+        self.channel_loader = Loader(
+            partial(
+                self.get_batch,
+                "https://api.twitch.tv/helix/channels",
+                "broadcaster_id",
+            ),
+            itemgetter("broadcaster_id"),
+        )
+        self.user_loader = Loader(
+            self.fetch_users_batch, lambda user: user["login"].lower()
+        )
 
     async def subscribe(self, force: bool = False) -> bool:
         if not self.client_id and not self.client_secret:
             return False
-        elif (
-            time()
-            - int(
-                getenv(
-                    "twitch_since_last_check",
-                    (
-                        await config.get(
-                            "twitch_since_last_check", {"value": int(time()) - 14401}
-                        )
-                    )["value"],
-                )
-            )
-        ) < 14400 and not force:
-            return False
+        elif not force:
+            # Обычная проверка идёт по частям, полная - только принудительно
+            return await self.scheduler.tick()
+        # Если проверку уже выполняет другой экземпляр, этот её пропускает.
+        # В режиме шардов каждый экземпляр проверяет только свои каналы.
+        name = "twitch_check"
+        if self.sharding.enabled:
+            name += "_" + self.sharding.member_id
+        async with Lease(config, name) as lease:
+            if not lease.acquired:
+                # None - проверка уже идёт в другом экземпляре
+                return None
+            return await self.reconcile(lease)
+
+    async def reconcile(self, lease: Lease) -> bool:
         subscribed = False
         tasks = []
-        subscriptions, enabled_subscriptions = await asyncio.gather(
-            asyncio.create_task(config.get("subscriptions", {"value": []})),
-            asyncio.create_task(self.get_eventsub_subscriptions()),
-        )
+        subscriptions = await config.get("subscriptions", {"value": []})
+        subscriptions["value"] = [
+            sub for sub in subscriptions["value"] if self.sharding.owns(sub["id"])
+        ]
+        subscribed_ids = {sub["id"] for sub in subscriptions["value"]}
         sub_ids = {}
-        for sub in enabled_subscriptions:
-            if sub["condition"]["broadcaster_user_id"] not in sub_ids:
-                sub_ids[sub["condition"]["broadcaster_user_id"]] = {}
-            sub_ids[sub["condition"]["broadcaster_user_id"]][
-                sub["type"].replace(".", "")
-            ] = sub["id"]
-        for user_id, subs in sub_ids.items():
-            if not any(user_id == sub["id"] for sub in subscriptions["value"]):
-                for sub_id in subs.values():
-                    tasks.append(
-                        asyncio.create_task(self.delete_eventsub_subscription(sub_id))
-                    )
+        # Подписки обрабатываются по мере загрузки страниц
+        async for sub in self.iter_eventsub_subscriptions():
+            user_id = sub["condition"]["broadcaster_user_id"]
+            if not self.sharding.owns(user_id):
                 continue
-            elif len(subs) != 3:
-                subscribed = True
-                for type in ("stream.online", "stream.offline", "channel.update"):
-                    if type.replace(".", "") not in subs:
-                        tasks.append(
-                            asyncio.create_task(
-                                self.create_eventsub_subscription("stream.online", user_id)
-                            )
-                        )
-            tasks.append(asyncio.create_task(config.update(user_id, set=subs)))
-        for sub in subscriptions["value"]:
-            if sub["id"] not in sub_ids:
-                subscribed = True
-                for type in ("stream.online", "stream.offline", "channel.update"):
-                    tasks.append(
-                        asyncio.create_task(
-                            self.create_eventsub_subscription(type, user_id)
-                        )
-                    )
-        tasks.append(asyncio.create_task(config.put({"key": "twitch_since_last_check", "value": int(time())})))
-        environ["twitch_since_last_check"] = str(int(time()))
-        channels = await self.combine_channel_data(
-            list(sub["id"] for sub in subscriptions["value"])
+            if user_id not in subscribed_ids:
+                tasks.append(
+                    asyncio.create_task(self.delete_eventsub_subscription(sub["id"]))
+                )
+                continue
+            sub_ids.setdefault(user_id, {})[sub["type"].replace(".", "")] = sub["id"]
+        missing = []
+        for user_id in subscribed_ids:
+            subs = sub_ids.get(user_id, {})
+            for type in ("stream.online", "stream.offline", "channel.update"):
+                if type.replace(".", "") not in subs:
+                    missing.append((type, user_id))
+            if subs:
+                tasks.append(asyncio.create_task(config.update(user_id, set=subs)))
+        if not await lease.is_held():
+            await asyncio.gather(*tasks)
+            return False
+        if missing:
+            subscribed = True
+            await self.check_eventsub_cost(len(missing))
+        for type, user_id in missing:
+            tasks.append(
+                asyncio.create_task(self.create_eventsub_subscription(type, user_id))
+            )
+        tasks.append(
+            asyncio.create_task(
+                set_timestamp(config, "twitch_since_last_check", int(time()))
+            )
         )
-        for id, channel in channels.items():
-            await config.update(id, set=channel)
+        await self.refresh_channels([sub["id"] for sub in subscriptions["value"]])
         await asyncio.gather(*tasks)
         return subscribed
 
@@ -216,28 +375,50 @@ class Twitch:
             self.headers["Client-Id"] = self.client_id
         return self.client_id and self.client_secret
 
-    async def create_app_token(self) -> bool:
+    async def create_app_token(self, force: bool = False) -> bool:
         if not self.client_id or not self.client_secret:
             if not self.get_client_id_and_client_secret():
                 return False
-        app_access_token = await config.get(
-            "dev_app_token"
-            if "ngrok" in getenv("DETA_SPACE_APP_HOSTNAME")
-            else "app_token"
-        )
-        if app_access_token and app_access_token["expires"] > time():
+        # Токен, полученный другим воркером, переиспользуется.
+        # force - текущий токен отклонён Twitch, нужен новый.
+        app_access_token = await get_shared_state().get("app_token")
+        if not app_access_token:
+            app_access_token = await config.get(
+                "dev_app_token"
+                if "ngrok" in getenv("DETA_SPACE_APP_HOSTNAME")
+                else "app_token"
+            )
+        if (
+            app_access_token
+            and app_access_token["expires"] > time()
+            and not (
+                force
+                and self.headers["Authorization"]
+                == "Bearer " + app_access_token["access_token"]
+            )
+        ):
             self.expires = app_access_token["expires"]
             self.headers["Authorization"] = "Bearer " + app_access_token["access_token"]
             return True
-        response = await self.session.post(
+        response = await breakers["helix"].request(
+            self.session,
+            "POST",
             "https://id.twitch.tv/oauth2/token",
+            HELIX_TIMEOUT,
             headers={"Content-Type": "application/x-www-form-urlencoded"},
             data=f"client_id={self.client_id}&client_secret={self.client_secret}&grant_type=client_credentials",
         )
         if response.status == 200:
-            app_access_token = await response.json()
+            app_access_token = await read_json(response)
             self.expires = int(time()) + app_access_token["expires_in"] - 30
             self.headers["Authorization"] = "Bearer " + app_access_token["access_token"]
+            await get_shared_state().set(
+                "app_token",
+                {
+                    "access_token": app_access_token["access_token"],
+                    "expires": self.expires,
+                },
+            )
             await config.put(
                 {
                     "access_token": app_access_token["access_token"],
@@ -264,7 +445,7 @@ class Twitch:
         response = await self.make_api_request(
             "GET", "https://id.twitch.tv/oauth2/validate"
         )
-        data = await response.json()
+        data = await read_json(response)
         if (
             not response
             or "client_id" not in data
@@ -284,17 +465,26 @@ class Twitch:
                 "type": type,
                 "version": VERSION[type],
                 "condition": {"broadcaster_user_id": broadcaster_user_id},
-                "transport": {
-                    "method": "webhook",
-                    "callback": f"https://{getenv('DETA_SPACE_APP_HOSTNAME')}/twitchwebhook",
-                    "secret": getenv("secret"),
-                },
+                "transport": await self.get_transport(),
             },
         )
         if response.status != 202:
-            print(await response.json())
+            print(await read_json(response))
         return response
 
+    async def get_transport(self) -> dict:
+        if self.sharding.enabled:
+            # События приходят в conduit, а Twitch раздаёт их по шардам
+            return {
+                "method": "conduit",
+                "conduit_id": await self.sharding.get_conduit_id(),
+            }
+        return {
+            "method": "webhook",
+            "callback": f"https://{getenv('DETA_SPACE_APP_HOSTNAME')}/twitchwebhook",
+            "secret": getenv("secret"),
+        }
+
     async def delete_eventsub_subscription(self, subscription_id: str) -> None:
         # https://dev.twitch.tv/docs/api/reference/#delete-eventsub-subscription
         response = await self.make_api_request(
@@ -304,63 +494,150 @@ class Twitch:
         )
 
     async def get_eventsub_subscriptions(self) -> list:
+        return [sub async for sub in self.iter_eventsub_subscriptions()]
+
+    async def iter_eventsub_subscriptions(
+        self, status: str = "enabled", type: str = None, user_id: str = None
+    ):
         # https://dev.twitch.tv/docs/api/reference/#get-eventsub-subscriptions
-        subscriptions = []
+        # Twitch принимает только один фильтр, поэтому при type или user_id
+        # status проверяется уже здесь. Следующая страница грузится, пока отдаётся текущая.
+        if type:
+            params = {"type": type}
+        elif user_id:
+            params = {"user_id": user_id}
+        else:
+            params = {"status": status}
+        page = asyncio.create_task(self.get_eventsub_page(params))
+        try:
+            while page:
+                json_response = await page
+                page = None
+                cursor = json_response.get("pagination", {}).get("cursor")
+                if cursor:
+                    page = asyncio.create_task(
+                        self.get_eventsub_page({**params, "after": cursor})
+                    )
+                for sub in json_response["data"]:
+                    if status and sub["status"] != status:
+                        continue
+                    yield sub
+        finally:
+            if page:
+                page.cancel()
+
+    async def get_eventsub_page(self, params: dict) -> dict:
         response = await self.make_api_request(
             "GET",
             "https://api.twitch.tv/helix/eventsub/subscriptions",
-            params={"status": "enabled"},
+            params=params,
         )
-        if not response or response.status != 200:
-            return []
-        json_response = await response.json()
-        subscriptions += json_response["data"]
-        while "cursor" in json_response["pagination"]:
-            response = await self.make_api_request(
-                "GET",
-                "https://api.twitch.tv/helix/eventsub/subscriptions",
-                params={
-                    "status": "enabled",
-                    "after": json_response["pagination"]["cursor"],
-                },
-            )
-            json_response = await response.json()
-            subscriptions += json_response["data"]
-        return subscriptions
+        # По неполному списку проверка решила бы, что остальных подписок нет,
+        # и стала бы создавать их заново
+        if not response:
+            raise UpstreamError("helix: no app access token")
+        if response.status != 200:
+            raise UpstreamError(f"helix: subscriptions page returned {response.status}")
+        json_response = await read_json(response)
+        self.eventsub_cost = {
+            "total": json_response["total"],
+            "total_cost": json_response["total_cost"],
+            "max_total_cost": json_response["max_total_cost"],
+        }
+        return json_response
+
+    async def check_eventsub_cost(self, needed: int = 0) -> bool:
+        # Предупреждает, если новые подписки приблизят нас к лимиту стоимости EventSub
+        if not self.eventsub_cost:
+            return True
+        total_cost = self.eventsub_cost["total_cost"] + needed
+        max_total_cost = self.eventsub_cost["max_total_cost"]
+        if total_cost < max_total_cost * COST_WARNING:
+            return True
+        global telegram
+        if "telegram" not in globals():
+            from main import telegram
+        text = f"Стоимость подписок EventSub: {total_cost} из {max_total_cost}."
+        print(text)
+        if get("Telegram_Id"):
+            await telegram.send_message(get("Telegram_Id"), text)
+        return total_cost <= max_total_cost
 
     async def get_users(self, login: str):
+        users = await self.get_users_by_login([login])
+        return users[0] if users else None
+
+    async def get_users_by_login(self, logins: list) -> list:
         # https://dev.twitch.tv/docs/api/reference/#get-users
+        users = []
+        missing = []
+        for login in logins:
+            cached, user = await self.users.get_by_login(login)
+            if not cached:
+                missing.append(login)
+            elif user:
+                users.append(user)
+        if missing:
+            users += await self.fetch_users_by_login(missing)
+        return users
+
+    async def fetch_users_by_login(self, logins: list) -> list:
+        users = await self.user_loader.load_many([login.lower() for login in logins])
+        return [user for user in users if user]
+
+    async def fetch_users_batch(self, logins: list) -> list:
         response = await self.make_api_request(
-            "GET", "https://api.twitch.tv/helix/users", params={"login": login}
+            "GET",
+            "https://api.twitch.tv/helix/users",
+            params=[("login", login) for login in logins],
         )
-        users = await response.json()
-        if response.status != 200 or "data" not in users or not users["data"]:
-            return None
-        return users["data"][0]
+        if not response or response.status != 200:
+            return []
+        users = (await read_json(response)).get("data", [])
+        for user in users:
+            await self.users.put(user)
+        # Логины, которых нет на Twitch, тоже кэшируются
+        found = {user["login"].lower() for user in users}
+        for login in logins:
+            if login not in found:
+                await self.users.put_missing(login)
+        return users
+
+    async def warm_users(self) -> None:
+        subscriptions = await config.get("subscriptions", {"value": []})
+        self.users.warm(subscriptions["value"])
 
     async def get_channel_information(self, ids: list) -> dict:
         # https://dev.twitch.tv/docs/api/reference/#get-channel-information
-        if not ids:
-            return {"data": []}
-        query = "broadcaster_id=" + "&broadcaster_id=".join(ids)
-        response = await self.make_api_request(
-            "GET", f"https://api.twitch.tv/helix/channels?{query}"
-        )
-        if response.status != 200:
-            return {"data": []}
-        return await response.json()
+        channels = await self.channel_loader.load_many(list(dict.fromkeys(ids)))
+        return {"data": [channel for channel in channels if channel]}
 
-    async def get_streams(self, ids: list) -> dict:
+    async def get_streams(self, ids: list, partial: bool = False) -> dict:
         # https://dev.twitch.tv/docs/api/reference/#get-streams
-        if not ids:
-            return {"data": []}
-        query = "user_id=" + "&user_id=".join(ids)
+        # С partial ошибка одной пачки не прерывает остальные, её id попадают
+        # в failed: про них неизвестно, идёт стрим или нет
+        ids = list(dict.fromkeys(ids))
+        streams = await self.stream_loader.load_many(ids, return_exceptions=partial)
+        failed = [id for id, item in zip(ids, streams) if isinstance(item, Exception)]
+        return {
+            "data": [
+                item for item in streams if item and not isinstance(item, Exception)
+            ],
+            "failed": failed,
+        }
+
+    async def get_batch(self, url: str, name: str, ids: list) -> list:
+        # Helix принимает до 100 id в одном запросе, пачки собирает Loader
         response = await self.make_api_request(
-            "GET", f"https://api.twitch.tv/helix/streams?{query}"
+            "GET", url, params=[(name, id) for id in ids]
         )
+        # Ошибка не должна выглядеть как "ничего не найдено", иначе каналы из пачки
+        # будут считаться офлайн
+        if not response:
+            raise UpstreamError("helix: no app access token")
         if response.status != 200:
-            return {"data": []}
-        return await response.json()
+            raise UpstreamError(f"helix: {url} returned {response.status}")
+        return (await read_json(response))["data"]
 
     async def combine_channel_data(self, ids: list) -> dict:
         data = {id: {} for id in ids}
@@ -373,9 +650,11 @@ class Twitch:
                 "title": stream["title"],
                 "category": stream["game_name"],
                 "is_live": True,
-                "started_at": parse(stream["started_at"]).timestamp(),
-                "game_timestamp": parse(stream["started_at"]).timestamp(),
-                "game_time": {},
+                "stream_id": stream["id"],
+                "titles": [[parse(stream["started_at"]).timestamp(), stream["title"]]],
+                **Timeline.start(
+                    stream["game_name"], parse(stream["started_at"]).timestamp()
+                ).to_set(),
             }
         channels = await self.get_channel_information(ids)
         for channel in channels["data"]:
@@ -385,12 +664,39 @@ class Twitch:
                 "title": channel["title"],
                 "category": channel["game_name"],
                 "is_live": False,
+                "stream_id": None,
                 "started_at": None,
                 "game_timestamp": None,
                 "game_time": {},
+                "segments": [],
+                "titles": [],
             }
         return data
 
+    async def refresh_channels(self, ids: list) -> None:
+        # Обновляет документы каналов данными из Helix. У канала, который уже в эфире
+        # с тем же стримом, меняются только логин и имя: название, категория и
+        # таймлайн стрима ведутся событиями, иначе сессия начнётся заново
+        channels = await self.combine_channel_data(list(ids))
+        live = [id for id, channel in channels.items() if channel.get("is_live")]
+        for id, stored in zip(live, await config.get_many(live)):
+            if (
+                stored
+                and stored.get("is_live")
+                and stored.get("stream_id") == channels[id]["stream_id"]
+            ):
+                channels[id] = {
+                    "login": channels[id]["login"],
+                    "name": channels[id]["name"],
+                }
+        await asyncio.gather(
+            *(
+                config.update(id, set=channel)
+                for id, channel in channels.items()
+                if channel
+            )
+        )
+
     async def make_api_request(
         self,
         method: str,
@@ -405,11 +711,22 @@ class Twitch:
         if time() >= self.expires or not self.headers["Authorization"]:
             if not (await self.create_app_token()):
                 return None
-        response = await self.session.request(
-            method, url, headers=self.headers, params=params, json=json
+        headers = self.headers
+        data = None
+        if json is not None:
+            headers = {**self.headers, "Content-Type": "application/json"}
+            data = dumps(json)
+        response = await breakers["helix"].request(
+            self.session,
+            method,
+            url,
+            HELIX_TIMEOUT,
+            headers=headers,
+            params=params,
+            data=data,
         )
         if response.status == 401 and not retry:
-            await self.create_app_token()
+            await self.create_app_token(force=True)
             return await self.make_api_request(
                 method, url, params=params, json=json, retry=True
             )
@@ -419,6 +736,9 @@ class Twitch:
             )
             if time_to_sleep <= 0:
                 time_to_sleep = 1
+            # Ждать сброса лимита дольше срока запроса бессмысленно
+            if time_to_sleep > remaining(time_to_sleep + 1):
+                raise DeadlineExceeded("Helix rate limit resets after the deadline")
             await asyncio.sleep(time_to_sleep)
             return await self.make_api_request(
                 method, url, params=params, json=json, retry=True
@@ -426,49 +746,73 @@ class Twitch:
         return response
 
     async def process_event(self, request: Request, response: Response) -> Response:
-        response.status_code = 204
         body = await request.body()
+        # Подпись и время проверяются до разбора тела
+        if not verify_twitch(request.headers, body):
+            response.status_code = 403
+            response.init_headers()
+            return response
+        response.status_code = 204
+        shared = get_shared_state()
+        message_type = request.headers["Twitch-Eventsub-Message-Type"]
         try:
-            event = json.loads(body)
+            event = loads(body)
             if (
-                request.headers.get("Twitch-Eventsub-Message-Type", "")
-                == "notification"
+                message_type == "notification"
                 and "channel.update" == event["subscription"]["type"]
                 and event["event"]["content_classification_labels"]
-                != self.content_classification_labels
+                != await shared.get("content_classification_labels")
             ):
-                self.content_classification_labels = event["event"][
-                    "content_classification_labels"
-                ]
+                await shared.set(
+                    "content_classification_labels",
+                    event["event"]["content_classification_labels"],
+                )
                 return
-        except json.JSONDecodeError:
+        except DecodeError:
             response.status_code = 400
             response.init_headers()
             return response
-        message_type = request.headers.get("Twitch-Eventsub-Message-Type", "")
         type = event["subscription"]["type"]
-        user_id = event["subscription"]["condition"]["broadcaster_user_id"]
-        wrong_request = (
-            (not self.verify_hmac(request, body))
-            + (not self.verify_time(request))
-            + (type not in EVENTS)
-            + (
-                message_type
-                not in ("notification", "webhook_callback_verification", "revocation")
-            )
-        )
-        if wrong_request != 0:
+        user_id = event["subscription"]["condition"].get("broadcaster_user_id")
+        if type not in EVENTS and message_type != "webhook_callback_verification":
             response.status_code = 403
+        elif message_type != "webhook_callback_verification" and not self.sharding.owns(
+            user_id, request.headers
+        ):
+            # Событие пришло не тому экземпляру, пересылаем владельцу канала
+            if not await self.sharding.forward(user_id, request.headers, body):
+                response.status_code = 502
         elif message_type == "notification":
-            await EVENTS[type](event)
+            # Twitch может доставить одно и то же сообщение несколько раз
+            key = "event_" + request.headers.get("Twitch-Eventsub-Message-Id", "")
+            if await shared.add_once(key, 600):
+                # Как в EventSub WebSocket: id сообщения нужен для ключа превью
+                event["metadata"] = {
+                    "message_id": request.headers.get("Twitch-Eventsub-Message-Id"),
+                    "message_timestamp": request.headers.get(
+                        "Twitch-Eventsub-Message-Timestamp"
+                    ),
+                }
+                try:
+                    await EVENTS[type](event)
+                except UpstreamError as e:
+                    # Deta, Helix или Telegram временно недоступны: ключ освобождается,
+                    # а ответ не 2xx, чтобы Twitch прислал событие снова
+                    await shared.delete(key)
+                    print("Event postponed:", e)
+                    response.status_code = 503
+                except Exception:
+                    await shared.delete(key)
+                    raise
         elif message_type == "webhook_callback_verification":
             challenge = event["challenge"]
             response.status_code = 200
             response.media_type = "text/plain"
             response.body = response.render(challenge)
-            await config.update(
-                user_id, set={type.replace(".", ""): event["subscription"]["id"]}
-            )
+            if user_id and type in EVENTS:
+                await config.update(
+                    user_id, set={type.replace(".", ""): event["subscription"]["id"]}
+                )
         elif message_type == "revocation":
             tasks = []
             tasks.append(
@@ -481,35 +825,12 @@ class Twitch:
                     self.create_eventsub_subscription(type, broadcaster_user_id=user_id)
                 )
             )
+            # Канал с отозванной подпиской проверяется в следующий тик
+            tasks.append(asyncio.create_task(self.scheduler.mark_failed(user_id)))
             await asyncio.gather(*tasks)
         response.init_headers()
         return response
 
-    @staticmethod
-    def verify_hmac(request: Request, body: bytes) -> bool:
-        twitch_hmac = request.headers.get(
-            "Twitch-Eventsub-Message-Signature", ""
-        ).replace("sha256=", "")
-        my_hmac = hmac.digest(
-            getenv("secret").encode(),
-            request.headers.get("Twitch-Eventsub-Message-Id", "").encode()
-            + request.headers.get("Twitch-Eventsub-Message-Timestamp", "").encode()
-            + body,
-            hashlib.sha256,
-        ).hex()
-        return hmac.compare_digest(twitch_hmac, my_hmac)
-
-    @staticmethod
-    def verify_time(request: Request) -> bool:
-        twitch_time = parse(
-            request.headers.get(
-                "Twitch-Eventsub-Message-Timestamp", "2000-01-01T00:00:00Z"
-            )
-        )
-
-        my_time = datetime.utcnow().replace(tzinfo=timezone.utc)
-        return my_time - twitch_time < timedelta(days=0, seconds=600)
-
 
 if __name__ == "__main__":
     import asyncio
@@ -0,0 +1,85 @@
+from collections import OrderedDict
+from time import time
+
+from shared import get_shared_state, is_shared
+
+TTL = 24 * 60 * 60
+NEGATIVE_TTL = 10 * 60
+MAX_SIZE = 5000
+
+
+class UserCache:
+    # Кэш пользователей Twitch в обе стороны: логин -> пользователь и id -> логин.
+    # Несуществующие логины тоже запоминаются (на NEGATIVE_TTL), чтобы не спрашивать Helix повторно.
+    def __init__(
+        self, ttl: int = TTL, negative_ttl: int = NEGATIVE_TTL, max_size: int = MAX_SIZE
+    ) -> None:
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.by_login: OrderedDict[str, tuple] = OrderedDict()
+        self.by_id: dict[str, str] = {}
+
+    async def get_by_login(self, login: str) -> tuple:
+        # Возвращает (есть ли в кэше, пользователь или None)
+        login = login.lower()
+        if login not in self.by_login and is_shared():
+            # Пользователь мог быть загружен другим воркером
+            entry = await get_shared_state().get("user_" + login)
+            if entry:
+                self.remember(login, *entry)
+        if login not in self.by_login:
+            return False, None
+        user, expires = self.by_login[login]
+        if expires < time():
+            self.remove(login)
+            return False, None
+        self.by_login.move_to_end(login)
+        return True, user
+
+    async def get_by_id(self, id: str) -> dict:
+        login = self.by_id.get(id)
+        if login is None and is_shared():
+            login = await get_shared_state().get("user_id_" + id)
+        if login is None:
+            return None
+        return (await self.get_by_login(login))[1]
+
+    async def put(self, user: dict) -> None:
+        login = user["login"].lower()
+        self.remember(login, user, time() + self.ttl)
+        if is_shared():
+            await get_shared_state().set(
+                "user_" + login, [user, time() + self.ttl], self.ttl
+            )
+            await get_shared_state().set("user_id_" + user["id"], login, self.ttl)
+
+    async def put_missing(self, login: str) -> None:
+        login = login.lower()
+        self.remember(login, None, time() + self.negative_ttl)
+        if is_shared():
+            await get_shared_state().set(
+                "user_" + login, [None, time() + self.negative_ttl], self.negative_ttl
+            )
+
+    def remember(self, login: str, user: dict, expires: float) -> None:
+        self.remove(login)
+        self.by_login[login] = (user, expires)
+        if user:
+            self.by_id[user["id"]] = login
+        self.trim()
+
+    def remove(self, login: str) -> None:
+        user, _ = self.by_login.pop(login, (None, 0))
+        if user and self.by_id.get(user["id"]) == login:
+            del self.by_id[user["id"]]
+
+    def trim(self) -> None:
+        while len(self.by_login) > self.max_size:
+            self.remove(next(iter(self.by_login)))
+
+    def warm(self, subscriptions: list) -> None:
+        for sub in subscriptions:
+            if sub["login"].lower() not in self.by_login:
+                user = {"id": sub["id"], "login": sub["login"]}
+                self.remember(sub["login"].lower(), user, time() + self.ttl)
@@ -1,9 +1,16 @@
+import re
 from os import getenv
 from aiohttp import ClientSession
-from template import Template
+from codec import dumps_text
+from entities import compile_template
+from timeline import Timeline, format_duration
 from functools import partial
 import time
 
+SKIPPABLE = {"gametime", "uptime", "categories", "new_category", "new_title"}
+# https://core.telegram.org/bots/api#sendmessage
+MAX_MESSAGE_LENGTH = 4096
+
 
 def escape_symbols(input_string):
     symbols_to_escape = [
@@ -39,6 +46,35 @@ def get(key: str):
     return value
 
 
+def parse_logins(text: str) -> list:
+    # Логины и ссылки на каналы через пробел, запятую или с новой строки
+    logins = []
+    for word in re.split(r"[\s,;]+", text.lower()):
+        if "twitch.tv/" in word:
+            word = word.split("twitch.tv/")[-1].split("?")[0].split("/")[0]
+        word = word.strip("@")
+        if re.fullmatch(r"\w{1,25}", word) and word not in logins:
+            logins.append(word)
+    return logins
+
+
+def join_limited(lines: list, limit: int, separator: str = "\n") -> str:
+    # Склеивает строки, пока текст помещается в limit символов, остальные
+    # заменяются на "…и ещё N"
+    text = separator.join(lines)
+    if len(text) <= limit:
+        return text
+    text = ""
+    for i, line in enumerate(lines):
+        candidate = text + separator + line if text else line
+        left = len(lines) - i - 1
+        more = f"{separator}…и ещё {left}" if left else ""
+        if len(candidate) + len(more) > limit:
+            return (text + separator if text else "") + f"…и ещё {len(lines) - i}"
+        text = candidate
+    return text
+
+
 def get_channel_value(key: str, channel: dict, event: dict):
     return channel.get(key, None)
 
@@ -53,49 +89,25 @@ def get_event_value(key: str, channel: dict, event: dict):
 
 
 def gametime(key: str, channel: dict, event: dict):
-    if channel["is_live"]:
-        game_time = (
-            channel["game_time"][channel["category"]]
-            if channel["game_time"] and channel["category"] in channel["game_time"]
-            else 0
-        )
-        if not game_time:
-            return time.strftime(
-                "%H:%M:%S", time.gmtime(time.time() - channel["game_timestamp"])
-            )
-        return time.strftime("%H:%M:%S", time.gmtime(game_time))
+    timeline = Timeline.from_channel(channel)
+    if timeline:
+        return format_duration(timeline.category_time(time.time()))
     else:
         return None
 
 
 def games(key: str, channel: dict, event: dict):
-    if channel["is_live"]:
-        if channel["game_time"]:
-            games = ""
-            for game, gametime in channel["game_time"].items():
-                played_time = gametime
-                if game == channel["category"]:
-                    played_time += time.time() - channel["game_timestamp"]
-                if played_time < 60:
-                    continue
-                games += (
-                    f'{game} [{time.strftime("%H:%M:%S", time.gmtime(played_time))}] | '
-                )
-            if channel["category"] not in channel["game_time"]:
-                games += f'{channel["category"]} [{time.strftime("%H:%M:%S", time.gmtime(time.time() - channel["game_timestamp"]))}] | '
-            games = games[:-3]
-        else:
-            games = f'{channel["category"]} [{time.strftime("%H:%M:%S", time.gmtime(time.time() - channel["game_timestamp"]))}]'
-        return games
+    timeline = Timeline.from_channel(channel)
+    if timeline:
+        return timeline.summary(time.time())
     else:
         return None
 
 
 def uptime(key: str, channel: dict, event: dict):
-    if channel["is_live"]:
-        return time.strftime(
-            "%H:%M:%S", time.gmtime(time.time() - channel["started_at"])
-        )
+    timeline = Timeline.from_channel(channel)
+    if timeline:
+        return format_duration(timeline.uptime(time.time()))
     else:
         return None
 
@@ -104,7 +116,8 @@ def stream_url(key: str, channel: dict, event: dict):
     return "https://twitch.tv/" + channel.get("login")
 
 
-def format_text(channel: dict, event: dict, text: str):
+def format_text(channel: dict, event: dict, text: str) -> tuple:
+    # Возвращает текст и список entities для Telegram
     MAPPING = {
         "username": partial(get_channel_value, "name", channel, event),
         "login": partial(get_channel_value, "login", channel, event),
@@ -117,28 +130,9 @@ def format_text(channel: dict, event: dict, text: str):
         "gametime": partial(gametime, None, channel, event),
         "stream_url": partial(stream_url, None, channel, event),
     }
-    mapped = {}
-    final_text = ""
-    for line in text.split("\n"):
-        skip_line = False
-        template = Template(line)
-        identifiers = tuple(map(str.lower, template.get_identifiers()))
-        for identifier in identifiers:
-            if identifier not in MAPPING:
-                continue
-            value = MAPPING[identifier]()
-            if (
-                value is None
-                and identifier in ("gametime", "uptime", "categories", "new_category", "new_title")
-                and len(identifiers) == 1
-            ):
-                skip_line = True
-                break
-            mapped[identifier] = escape_symbols(value or "-")
-        if skip_line:
-            continue
-        final_text += template.safe_substitute(mapped) + "\n"
-    return smart_escape(final_text[:-1])
+    template = compile_template(text)
+    values = {name: MAPPING[name]() for name in template.names if name in MAPPING}
+    return template.render(values, SKIPPABLE)
 
 
 session = None
@@ -147,53 +141,12 @@ session = None
 async def get_session() -> ClientSession:
     global session
     if session is None:
-        session = ClientSession()
+        session = ClientSession(json_serialize=dumps_text)
     return session
 
 
-def smart_escape(text: str) -> str:
-    og_text = text
-    # Добавить поддержку ``````
-    for symbol in [">", "#", "+", "-", "=", "{", "}", ".", "!"]:
-        text = text.replace(symbol, f"\\{symbol}")
-    if "|" in text:
-        text = text.replace("|", "\\|")
-        if text.count("\\|\\|") % 2 == 0:
-            text = text.replace("\\|\\|", "||")
-    new = ""
-    for line in text.split("\n"):
-        for symbol in ["*", "_", "~", "`"]:
-            aline = line.replace(f"\\{symbol}", "")
-            if aline.count(symbol) % 2:
-                line = line.replace(symbol, f"\\{symbol}")
-        if "[" in line and "](" in line and ")" in line:
-            if "[]" in line or "()" in line:
-                for symbol in "[]()":
-                    line = line.replace(symbol, f"\\{symbol}")
-            else:
-                for symbol in "[](://)":
-                    aline = line.replace(f"\\{symbol}", "")
-                wrong = False
-                i = -1
-                prev_i = -1
-                for symbol in "[](://)":
-                    i = aline.find(symbol, i + 1)
-                    if i == -1 or i < prev_i:
-                        wrong = True
-                        break
-                if wrong:
-                    for symbol in "[]()":
-                        line = line.replace(symbol, f"\\{symbol}")
-        elif "[" in line or "]" in line or "(" in line or ")" in line:
-            for symbol in "[]()":
-                line = line.replace(symbol, f"\\{symbol}")
-        new += line + "\n"
-    new = new[:-1]
-    while "\\\\" in new:
-        # Использовать og_text для того чтобы игнорировать \\\\, если они есть в оригинальном тексте
-        new = new.replace("\\\\", "\\")
-    cant_be_empty = ["*", "||", "__", "~", "`"]
-    for symbol in cant_be_empty:
-        if symbol * 2 in new:
-            new = new.replace(symbol * 2, ("\\" + "\\".join(symbol)) * 2)
-    return new
+async def close_session() -> None:
+    global session
+    if session is not None:
+        await session.close()
+        session = None
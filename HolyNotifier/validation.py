@@ -0,0 +1,80 @@
+import hashlib
+import hmac
+from calendar import timegm
+from os import getenv
+from time import time
+
+MAX_AGE = 600
+MAX_SKEW = 60
+TWITCH_TYPES = ("notification", "webhook_callback_verification", "revocation")
+
+# Проверки запускаются до разбора JSON, поэтому поддельный запрос стоит
+# одного HMAC по телу. Ключи считаются один раз: secret появляется в окружении
+# только после импорта main, поэтому не при импорте модуля.
+keys: dict[str, bytes] = {}
+
+
+def get_key(name: str) -> bytes:
+    key = keys.get(name)
+    if key is None:
+        secret = getenv("secret", "").encode()
+        if not secret:
+            return b""
+        keys["twitch"] = secret
+        # https://core.telegram.org/bots/api#setwebhook
+        # secret_token: 1-256 символов A-Z, a-z, 0-9, _ и -
+        token = hmac.digest(secret, b"telegram", hashlib.sha256).hex()
+        keys["telegram"] = token.encode()
+        key = keys[name]
+    return key
+
+
+def parse_iso(value: str) -> float:
+    # Быстрый разбор RFC 3339 от Twitch: 2023-06-29T17:20:33.860897266Z.
+    # Дробная часть может быть до наносекунд, поэтому datetime.fromisoformat не подходит.
+    try:
+        seconds = timegm(
+            (
+                int(value[0:4]),
+                int(value[5:7]),
+                int(value[8:10]),
+                int(value[11:13]),
+                int(value[14:16]),
+                int(value[17:19]),
+            )
+        )
+    except (ValueError, IndexError):
+        return None
+    if value[4] != "-" or value[10] not in "Tt" or value[-1] not in "Zz":
+        return None
+    return float(seconds)
+
+
+def verify_twitch(headers, body: bytes) -> bool:
+    # https://dev.twitch.tv/docs/eventsub/handling-webhook-events/#verifying-the-event-message
+    if headers.get("Twitch-Eventsub-Message-Type") not in TWITCH_TYPES:
+        return False
+    timestamp = headers.get("Twitch-Eventsub-Message-Timestamp", "")
+    sent = parse_iso(timestamp)
+    if sent is None or not -MAX_SKEW < time() - sent < MAX_AGE:
+        return False
+    signature = headers.get("Twitch-Eventsub-Message-Signature", "")
+    key = get_key("twitch")
+    if not key or not signature.startswith("sha256="):
+        return False
+    message_id = headers.get("Twitch-Eventsub-Message-Id", "")
+    digest = hmac.new(key, message_id.encode(), hashlib.sha256)
+    digest.update(timestamp.encode())
+    digest.update(body)
+    return hmac.compare_digest(signature[7:], digest.hexdigest())
+
+
+def telegram_secret_token() -> str:
+    return get_key("telegram").decode()
+
+
+def verify_telegram(headers) -> bool:
+    # https://core.telegram.org/bots/api#setwebhook
+    key = get_key("telegram")
+    token = headers.get("X-Telegram-Bot-Api-Secret-Token", "").encode()
+    return bool(key) and hmac.compare_digest(token, key)